@@ -1,23 +1,31 @@
-import cv2
 import numpy as np
 import functools
 from pathlib import Path
 from enum import Enum
 import time
 
-from config import MAX_WIDTH, MAX_HEIGHT, IMG_TYPES
+from config import MAX_WIDTH, MAX_HEIGHT, MASK_FORMAT, RECURSIVE_INPUT
 import utils
 from sam_worker import FastSAMWorker, SAMWorker
 from widgets.ImageLabel import ImageLabel
+from widgets.MaskView import MaskView
+from widgets.TiledView import TiledView
 from widgets.LabelSelector import LabelSelector
 from labeler import Labeler
+from image_index import ImageIndex
+from image_cache import image_cache, image_size, use_tiles
+from tiled_image import open_tiled
+from mask_writer import get_mask_writer, read_mask, MaskSaver, TiledMaskWriter
+from progress_index import ProgressIndex, LABELED
+from prefetcher import Prefetcher
+from job_queue import JobQueue
+from model_registry import registry
+from model_pool import ModelPool
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import QTextCursor
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, pyqtSlot
-
-import torch
-cuda = torch.cuda.is_available()
+from PyQt5.QtCore import Qt, pyqtSlot
+import startup
 
 
 class SegmentMode(Enum):
@@ -27,8 +35,6 @@ class SegmentMode(Enum):
         
 
 class GUI(QWidget):
-    init_sam = pyqtSignal(str)
-    
     def __init__(self, in_dir: Path, out_dir: Path, resume_progress=False):
         super().__init__()
         
@@ -36,18 +42,31 @@ class GUI(QWidget):
         self.out_dir = out_dir
         
         self.img_idx = 0
-        self.img_list = list(self.in_dir.iterdir())
-        self.mask_list = list(self.out_dir.iterdir()) if resume_progress else []
+        self.progress = ProgressIndex(self.out_dir)
+        self.resume_progress = resume_progress
+        self.navigated = False
+        self.open_image_list()
+        if resume_progress and self.img_list.complete:
+            self.img_idx = self.progress.first_unlabeled(self.img_list)
         self.curr_label = {}
+        self.mask_writer = get_mask_writer(MASK_FORMAT)
+        self.tiled_writer = TiledMaskWriter()
+        self.mask_saver = MaskSaver()
             
-        self.img = cv2.imread(str(self.img_list[0])) if self.img_list else np.zeros((240, 320, 3))
-        self.full_height, self.full_width = self.img.shape[:2]
+        # large TIFFs are shown and annotated in tiles at full resolution
+        self.tiled = bool(self.img_list) and use_tiles(self.img_list[self.img_idx])
+        if self.img_list:
+            self.img = self.working_copy(self.img_list[self.img_idx])
+            self.full_height, self.full_width = image_size(self.img_list[self.img_idx])
+        else:
+            self.img = np.zeros((240, 320, 3))
+            self.full_height, self.full_width = self.img.shape[:2]
         self.check_size()
+        startup.mark('first image decoded')
 
-        self.sam_thread = QThread()
-        model_type = utils.read_config_file('model')
-        model_type = 'SAM' if not model_type else model_type
-        self.init_model(model_type)
+        self.models = ModelPool(on_job_done=self.job_failed)
+        self.prefetcher = Prefetcher()
+        self.sam = None # set by start_model once the window is shown
 
         self.labeler = None
         self.segment_mode = SegmentMode.SINGLE_POINT
@@ -69,8 +88,9 @@ class GUI(QWidget):
         self.img_label = ImageLabel(self.img)
         
         print('Image shape: ', self.width, self.height)
-        self.mask = utils.np_to_qt(np.zeros((self.height,self.width,3)))
-        self.mask_label = QLabel()
+        self.mask_label = MaskView(self.height, self.width)
+        self.tiled_view = TiledView(2 * MAX_WIDTH, MAX_HEIGHT) # replaces both views for tiled images
+        self.canvas = self.img_label # view that takes the prompts
         
         # Side menu
         self.side_menu_layout = QVBoxLayout()
@@ -92,7 +112,10 @@ class GUI(QWidget):
         self.multi_point_btn = QRadioButton('Multi-Point')
         self.box_btn = QRadioButton('Box')
         self.generate_btn = QPushButton('Generate Mask')
+        self.new_object_btn = QPushButton('New Object')
         self.clear_btn = QPushButton('Clear Masks')
+        self.opacity_label = QLabel('Overlay: ')
+        self.opacity_slider = QSlider(Qt.Horizontal)
         self.file_box = QGridLayout()
         
         # Buttons
@@ -107,30 +130,33 @@ class GUI(QWidget):
         
         self.in_path.setText(str(self.in_dir))
         self.out_path.setText(str(self.out_dir))
-        self.progress_label.setText(f'1/{len(self.img_list)} images')
+        self.update_progress_label()
         self.generate_btn.setEnabled(False)
-        self.prev_btn.setEnabled(False)
+        self.new_object_btn.setEnabled(False)
         
         self.in_btn_browse.clicked.connect(lambda: self.getPath('input'))
         self.out_btn_browse.clicked.connect(lambda: self.getPath('output'))
         self.next_btn.clicked.connect(self.next_image)
         self.prev_btn.clicked.connect(self.prev_image)
         self.generate_btn.clicked.connect(self.generate_mask)
+        self.new_object_btn.clicked.connect(self.new_object)
         self.single_point_btn.clicked.connect(lambda: self.change_mode(SegmentMode.SINGLE_POINT))
         self.multi_point_btn.clicked.connect(lambda: self.change_mode(SegmentMode.MULTI_POINT))
         self.box_btn.clicked.connect(lambda: self.change_mode(SegmentMode.BOX))
         self.clear_btn.clicked.connect(self.clear_masks)
+        self.opacity_slider.valueChanged.connect(lambda v: self.img_label.set_overlay_opacity(v / 100))
+        self.opacity_slider.valueChanged.connect(lambda v: self.tiled_view.set_overlay_opacity(v / 100))
         self.img_label.mousePressEvent = functools.partial(self.save_segmentation_point, source_object=self.img_label.mousePressEvent)
+        self.tiled_view.pressed.connect(self.save_segmentation_point)
+        self.tiled_view.view_changed.connect(self.prefetch_tiles)
         self.label_selector.label_changed.connect(self.set_label)
         self.model_selector.activated.connect(self.change_model)
+        self.mask_saver.saved.connect(self.mask_saved)
+        self.mask_saver.failed.connect(lambda path, err: self.log(f'Mask failed to save to {path}: {err}', color='red'))
         
-        self.log(f'Cuda is available: ')
-        if cuda:
-            self.log('True', color='green', new_line=False)
-            self.log(f'Pytorch CUDA Version is {torch.version.cuda}')
-        else:
-            self.log('False', color='red', new_line=False)
-        self.log(f'Loading model {str(self.sam)} at checkpoint {self.sam.check_point}... ')
+        if self.img_idx > 0:
+            self.log(f'{self.progress.counts().get(LABELED, 0)} images already labeled, '
+                     f'resuming at image {self.img_idx+1}')
         
         
         
@@ -158,11 +184,15 @@ class GUI(QWidget):
         self.settings_layout.addWidget(self.single_point_btn)
         self.settings_layout.addWidget(self.multi_point_btn)
         self.settings_layout.addWidget(self.box_btn)
-        self.model_selector.addItems(['SAM', 'FastSAM'])
-        self.model_selector.setCurrentIndex(self.model_selector.findText(str(self.sam)))
+        self.refresh_model_selector()
         self.settings_layout.addWidget(self.model_selector)
         self.settings_layout.addWidget(self.generate_btn)
+        self.settings_layout.addWidget(self.new_object_btn)
         self.settings_layout.addWidget(self.clear_btn)
+        self.opacity_slider.setRange(0, 100)
+        self.opacity_slider.setMaximumWidth(100)
+        self.settings_layout.addWidget(self.opacity_label)
+        self.settings_layout.addWidget(self.opacity_slider)
         self.main_layout.addLayout(self.settings_layout)
         
         # Menu layout
@@ -171,7 +201,6 @@ class GUI(QWidget):
         self.side_menu_layout.addStretch()
         
         # Image layout
-        self.mask_label.setPixmap(self.mask)
         self.img_label.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Maximum)
         self.progress_label.setAlignment(Qt.AlignCenter)
         self.progress_label.setStyleSheet('font-size: 14pt;')
@@ -181,9 +210,11 @@ class GUI(QWidget):
         self.image_layout.addStretch()
         self.image_layout.addWidget(self.img_label)
         self.image_layout.addWidget(self.mask_label)
+        self.image_layout.addWidget(self.tiled_view)
         self.image_layout.addStretch()
         self.center_layout.addLayout(self.image_layout)
         self.main_layout.addLayout(self.center_layout)
+        self.show_canvas()
         
         # Buttons layout
         self.btns_layout.addWidget(self.prev_btn)
@@ -209,108 +240,209 @@ class GUI(QWidget):
         path = Path(path)
         
         if IO == 'input':
+            if self.labeler and self.img_list: self.save_mask()
             self.in_dir = path
             self.img_idx = 0
-            self.img_list.clear()
-            for type in IMG_TYPES:
-                self.img_list.extend(path.glob(type))
-            
-            self.next_image()
-            self.in_path.setText(path)
+            self.open_image_list()
+            if self.img_list: self.load_image()
+            self.in_path.setText(str(path))
         elif IO == 'output':
             self.out_dir = path
-            self.out_path.setText(path)
+            self.mask_saver.flush()
+            self.progress.close()
+            self.progress = ProgressIndex(self.out_dir)
+            self.out_path.setText(str(path))
 
-    def next_image(self):
-        
-        if not self.prev_btn.isEnabled():
-            self.prev_btn.setEnabled(True)
-        
-        # save mask
-        img_type = self.img_list[self.img_idx].suffix[1:]
-        mask_name = str(self.img_list[self.img_idx].stem) + '_mask'
-        out_file = self.out_dir / mask_name
+    # list the input folder in the background, returns once the first image is known
+    def open_image_list(self):
+        self.img_list = ImageIndex(self.in_dir, snapshot_dir=self.out_dir, recursive=RECURSIVE_INPUT)
+        self.img_list.found.connect(self.update_progress_label)
+        self.img_list.finished.connect(self.image_list_ready)
+        self.img_list.start()
+        self.img_list.wait_first()
+
+    @pyqtSlot()
+    def image_list_ready(self):
+        if self.sender() is not self.img_list: return
+        first_unlabeled = self.progress.first_unlabeled(self.img_list)
+        if self.resume_progress and not self.navigated and first_unlabeled != self.img_idx:
+            if self.labeler: self.save_mask()
+            self.img_idx = first_unlabeled
+            self.load_image()
+        self.update_progress_label()
+
+    @pyqtSlot()
+    def update_progress_label(self):
+        if not hasattr(self, 'progress_label'): return
+        more = '' if self.img_list.complete else '+'
+        self.progress_label.setText(f'{self.img_idx+1}/{len(self.img_list)}{more} images')
+        self.prev_btn.setEnabled(self.img_idx > 0)
+        if self.img_idx < len(self.img_list) - 1: self.next_btn.setEnabled(True)
+
+    def save_mask(self):
+        img_path = self.img_list[self.img_idx]
+        # a tiled annotation is handed to the saver whole and read back from its file if needed again
+        writer = self.tiled_writer if self.tiled else self.mask_writer
+        out_file = writer.mask_path(self.out_dir, img_path, self.in_dir)
         
         try:
-            np.save(out_file, self.labeler.get_mask())
+            mask = self.labeler.take_tiled() if self.tiled else self.labeler.get_mask()
+            # the saver thread reads a tiled annotation, painting it would modify its tile store
+            if self.tiled: self.tiled_view.set_annotation(None)
+            self.mask_saver.save(writer, out_file, mask,
+                                 on_saved=functools.partial(self.progress.mark_saved, img_path))
         except:
             self.log(f'Mask failed to save to {out_file}', color='red')
-            return
-        self.log(f'Mask saved to {out_file}')
+            return False
+        return True
+
+    @pyqtSlot(str)
+    def mask_saved(self, path):
+        self.log(f'Mask saved to {path}')
+        # a tiled annotation that is still on screen, e.g. of the last image, is shown again from its file
+        if self.tiled and self.labeler and self.tiled_view.annotation is None: self.update_mask()
+
+    # a tiled image is only shown by the tiled view, which decodes it in the background,
+    # so its working copy is a blank one of the same size
+    def working_copy(self, img_path):
+        if not use_tiles(img_path): return image_cache.load(img_path, (MAX_WIDTH, MAX_HEIGHT))
+        return np.zeros(utils.smart_size(image_size(img_path), (MAX_WIDTH, MAX_HEIGHT)) + (3,), dtype=np.uint8)
+
+    # show img_list[img_idx] and point the labeler and model at it
+    def load_image(self, direction=1):
+        img_path = self.img_list[self.img_idx]
+        self.img = self.working_copy(img_path)
+        h, w = self.full_height, self.full_width = image_size(img_path)
+        self.check_size()
+        self.img_label.setPixmap(self.img)
+        self.tiled = use_tiles(img_path)
+        self.show_canvas()
         
-        self.img_idx += 1
-        if len(self.img_list) <= self.img_idx:
+        # clear old points
+        self.canvas.clear_points()
+        
+        if self.labeler:
+            self.labeler.goto_annotation(str(img_path), (self.height, self.width), (h, w), tiled=self.tiled)
+            self.update_mask()
+        elif self.sam:
+            self.sam.submit('set_image', str(img_path))
+        self.prefetcher.schedule(self.img_list, self.img_idx, direction=direction)
+        self.update_progress_label()
+
+    def next_image(self):
+        if not self.save_mask(): return
+        
+        if len(self.img_list) <= self.img_idx + 1:
             self.log('End of dataset reached')
-            self.img_idx -= 1
             self.next_btn.setEnabled(False)
             return
         
-        # load new image
-        self.img = cv2.imread(str(self.img_list[self.img_idx]))
-        h, w = self.img.shape[:2]
-        self.check_size()
-        
-        self.labeler.next_annotation(str(self.img_list[self.img_idx]), (self.height, self.width), (h, w))
-        self.mask_label.setPixmap(self.labeler.get_mask_image())
-        
-        self.progress_label.setText(f'{self.img_idx+1}/{len(self.img_list)} images')
-        self.img_label.setPixmap(self.img)
-        
-        # clear old points
-        self.img_label.clear_points()
-    
+        self.img_idx += 1
+        self.navigated = True
+        self.load_image(direction=1)
         
     def prev_image(self):
+        if self.img_idx == 0: return
+        # only the current tiled annotation is kept, leaving it saves it
+        if self.tiled and not self.save_mask(): return
         self.img_idx -= 1
-        self.img_label.clear_points()
-        
-        self.labeler.prev_annotation(str(self.img_list[self.img_idx]))
-        self.mask_label.setPixmap(self.labeler.get_mask_image())
-        
-        self.img = cv2.imread(str(self.img_list[self.img_idx]))
-        self.check_size()
-        self.img_label.setPixmap(self.img)
-        
-        if not self.next_btn.isEnabled():
-            self.next_btn.setEnabled(True)
-            
-        if self.img_idx == 0:
-            self.prev_btn.setEnabled(False)
-        
-        self.progress_label.setText(f'{self.img_idx+1}/{len(self.img_list)} images')
+        self.navigated = True
+        self.load_image(direction=-1)
         
 
     def save_segmentation_point(self, event, source_object=None):
-        p = event.pos()
-        x, y = p.x(), p.y()
+        p = self.canvas.image_pos(event.pos())
         
-        if (x > self.width) or (y > self.height):
+        if p is None:
+            return
+        x, y = p.x(), p.y()
+        if self.segment_mode is SegmentMode.BOX:
+            self.canvas.start_box(event.pos())
             return
-        elif [x,y] in self.img_label.get_points():
+        elif [x,y] in self.canvas.get_points():
             self.log(f'Point ({x}, {y}) already selected for segmentation', color='yellow')
             return
         
+        # right click marks a point the object must not cover
+        negative = event.button() == Qt.RightButton
         if self.segment_mode is SegmentMode.SINGLE_POINT:
-            self.img_label.update_points(p, draw=False)
+            if negative: return
+            self.canvas.update_points(p, draw=False)
             self.generate_mask()
         else:
-            self.img_label.update_points(p)
+            self.canvas.update_points(p, label=0 if negative else 1)
+            # once the object has a mask every click refines it right away
+            if self.labeler and self.labeler.object_id is not None: self.generate_mask()
         
         
     def generate_mask(self):
         if not self.labeler: return
         if not self.curr_label:
-            self.img_label.clear_points()
+            self.canvas.clear_points()
             self.log('No label selected!', color='yellow')
             return
         
-        self.labeler.generate_mask(self.img_label.get_points(),
-                                   self.curr_label)
+        if self.segment_mode is SegmentMode.BOX:
+            # every box drawn since the last generate is decoded in one call
+            boxes = self.canvas.get_boxes()
+            if not boxes:
+                self.log('No boxes drawn!', color='yellow')
+                return
+            self.labeler.generate_mask([], self.curr_label, boxes=boxes)
+            self.canvas.clear_points()
+            return
+        
+        self.labeler.generate_mask(self.canvas.get_points(),
+                                   self.curr_label,
+                                   coalesce=self.segment_mode is SegmentMode.MULTI_POINT,
+                                   point_labels=self.canvas.get_point_labels())
         
         if self.segment_mode is SegmentMode.SINGLE_POINT:
-            self.img_label.clear_points()
-        self.mask_label.setPixmap(self.labeler.get_mask_image())
+            self.canvas.clear_points()
+    
+    # keep the current mask and start labeling another object
+    def new_object(self):
+        self.canvas.clear_points()
+        if self.labeler: self.labeler.end_object()
+    
+    # repaints only what changed since the last update, both views share the display buffer
+    @pyqtSlot()
+    def update_mask(self):
+        annotation = self.labeler.get_annotation()
+        if self.tiled:
+            rect = annotation.take_dirty()
+            if self.tiled_view.annotation is not annotation: self.tiled_view.set_annotation(annotation)
+            else: self.tiled_view.update_overlay(rect)
+            return
+        display = annotation.get_display_mask()
+        rect = annotation.take_dirty()
+        if self.mask_label.mask is not display:
+            self.mask_label.set_mask(display)
+            self.img_label.set_overlay(display)
+        else:
+            self.mask_label.update_rect(rect)
+            self.img_label.update_overlay(rect)
+
 
+    # tiled images swap both views for one zoomable view of the full resolution image
+    def show_canvas(self):
+        self.img_label.setVisible(not self.tiled)
+        self.mask_label.setVisible(not self.tiled)
+        self.tiled_view.setVisible(self.tiled)
+        self.canvas = self.tiled_view if self.tiled else self.img_label
+        if not self.tiled:
+            self.tiled_view.set_image(None)
+            self.tiled_view.set_annotation(None)
+            return
+        self.tiled_view.set_image(open_tiled(self.img_list[self.img_idx]))
+        # there is no separate mask view, so the overlay starts visible
+        if self.opacity_slider.value() == 0: self.opacity_slider.setValue(50)
+    
+    # encodes the tiles in view ahead of the first prompt, once zoomed in to full resolution
+    @pyqtSlot()
+    def prefetch_tiles(self):
+        if not self.tiled or self.tiled_view.level() != 0: return
+        self.prefetcher.schedule_tiles(self.img_list[self.img_idx], self.tiled_view.visible_tiles()[:4])
 
     # debugging
     def mousePressEvent(self, QMouseEvent):
@@ -318,23 +450,29 @@ class GUI(QWidget):
         x,y = p.x(),p.y()
         #self.log(f'Click at ({x}, {y})')
 
-    # initialize model on separate thread
-    def init_model(self, model_type):
-        if self.sam_thread.isRunning(): self.sam_thread.terminate()
-        if model_type == 'SAM':
-            self.sam = SAMWorker(cuda)
-        elif model_type == 'FastSAM':
-            self.sam = FastSAMWorker(cuda)
-        else:
-            print(f'Model {model_type} not found!')
+    # loads the last used model, called once the window is shown so the
+    # torch import and checkpoint load never delay it
+    def start_model(self):
+        model_name = utils.read_config_file('model')
+        self.init_model(registry.find(model_name if model_name else 'SAM'))
+        if self.sam: self.refresh_model_selector()
+    
+    # switch to a model, loading it on its own thread unless it is already resident
+    def init_model(self, spec):
+        if spec is None:
+            print('Model not found!')
             return
-        self.log(f'Loading model {model_type} at checkpoint {self.sam.check_point}... ')
-        self.sam_thread = QThread()
-        self.sam.moveToThread(self.sam_thread)
-        self.sam_thread.start(priority=QThread.TimeCriticalPriority)
-        self.sam.ready.connect(self.sam_ready)
-        self.init_sam.connect(self.sam.config_model)
-        self.init_sam.emit(str(self.img_list[0])) if self.img_list else self.init_sam.emit('')
+        img_path = str(self.img_list[self.img_idx]) if self.img_list else ''
+        worker_cls = SAMWorker if spec.family == 'SAM' else FastSAMWorker
+        self.sam, created = self.models.get(spec, img_path, worker_cls, on_ready=self.sam_ready)
+        self.prefetcher.set_worker(self.sam)
+        if created:
+            self.log(f'Loading model {spec.name} at checkpoint {self.sam.check_point}... ')
+        elif self.sam.configured:
+            self.log(f'Switched to {spec.name}')
+            self.activate_model(True)
+        else:
+            self.log(f'Waiting for {spec.name} to load... ')
 
     def change_mode(self, mode):
         self.segment_mode = mode
@@ -344,35 +482,100 @@ class GUI(QWidget):
             case SegmentMode.MULTI_POINT:
                 self.generate_btn.setEnabled(True)
             case SegmentMode.BOX:
-                self.generate_btn.setEnabled(False)
-        self.img_label.clear_points()
+                self.generate_btn.setEnabled(True)
+        self.new_object_btn.setEnabled(self.segment_mode is SegmentMode.MULTI_POINT)
+        self.new_object()
 
     def change_model(self):
-        model_name = self.model_selector.currentText()
-        if model_name == str(self.sam):
+        model_name = self.model_selector.currentData()
+        if self.sam is None or model_name == self.sam.spec.name:
             return
         utils.write_config_file(model_name, 'model')
-        self.init_model(model_name)
+        self.init_model(registry.get(model_name))
+    
+    # one entry per discovered checkpoint, with its measured cost on this device
+    def refresh_model_selector(self):
+        self.model_selector.clear()
+        if self.sam is None: return # filled in once a model is started
+        for spec in registry:
+            self.model_selector.addItem(registry.describe(spec.name, self.sam.device), spec.name)
+        self.model_selector.setCurrentIndex(self.model_selector.findData(self.sam.spec.name))
         
     def clear_masks(self):
+        if not self.labeler: return
+        self.canvas.clear_points()
         self.labeler.clear_mask()
-        self.mask_label.setPixmap(utils.np_to_qt(np.zeros((self.height,self.width,3))))
+        self.update_mask()
 
     @pyqtSlot(dict)
     def set_label(self, label_info):
         self.curr_label = label_info
+        self.new_object()
 
     @pyqtSlot(bool)
     def sam_ready(self, ret):
+        self.models.trim() # the loaded size of the model is known now
+        # a model the user switched away from while it was loading stays resident
+        if self.sender() is not self.sam: return
+        if ret: self.log('Ready', color='green', new_line=False)
+        else: self.log('Failed', color='red', new_line=False)
+        self.activate_model(ret)
+        startup.mark('model ready')
+        startup.report()
+    
+    # errors of jobs the labeler does not see, e.g. of a model loading before it exists
+    @pyqtSlot(object)
+    def job_failed(self, job):
+        if job.cancelled or job.error is None or job.kind in JobQueue.background: return
+        if self.labeler and self.sender() is self.labeler.sam: return # reported by the labeler
+        self.log(f'{self.sender()}: {job.kind} failed: {job.error}', color='red')
+    
+    # point the labeler at the current model and its predictor at the current image
+    def activate_model(self, ret):
         if not self.labeler:
-            self.labeler = Labeler(self.sam, (self.height, self.width), (self.full_height, self.full_width))
+            img_path = str(self.img_list[self.img_idx]) if self.img_list else ''
+            self.labeler = Labeler(self.sam, img_path, (self.height, self.width), (self.full_height, self.full_width),
+                                   mask_loader=self.load_mask, tiled=self.tiled)
+            for value, (label, color) in enumerate(self.label_selector.labels.items(), start=1):
+                self.labeler.set_label_color(value, color)
+            self.labeler.mask_updated.connect(self.update_mask)
+            self.labeler.failed.connect(lambda msg: self.log(msg, color='red'))
+            self.update_mask()
         else:
             self.labeler.update_sam(self.sam)
         
+        self.refresh_model_selector()
+        registry.save()
         if ret:
-            self.log('Ready', color='green', new_line=False)
+            img_path = str(self.img_list[self.img_idx]) if self.img_list else ''
+            if img_path and self.sam.image_path != img_path: self.sam.submit('set_image', img_path)
+            self.log_device()
+            self.prefetcher.schedule(self.img_list, self.img_idx, direction=1)
+    
+    # torch is already imported by the worker at this point
+    def log_device(self):
+        if self.sam.device is None or getattr(self, 'device_logged', False): return
+        import torch
+        
+        self.device_logged = True
+        self.log(f'Cuda is available: ')
+        if self.sam.cuda:
+            self.log('True', color='green', new_line=False)
+            self.log(f'Pytorch CUDA Version is {torch.version.cuda}')
         else:
-            self.log('Failed', color='red', new_line=False)
+            self.log('False', color='red', new_line=False)
+
+    # saved mask of an image, loaded when the image is first revisited
+    def load_mask(self, img_path):
+        # a tiled annotation handed to the saver may still be on its way to disk
+        if self.tiled: self.mask_saver.flush()
+        entry = self.progress.get(img_path)
+        if not entry or not entry['mask_path'] or not entry['mask_path'].exists(): return None
+        try:
+            return read_mask(entry['mask_path'])
+        except Exception as e:
+            self.log(f'Failed to load mask {entry["mask_path"]}: {e}', color='red')
+            return None
 
     def log(self, msg, color='white', new_line=True):
         if not hasattr(self, 'log_box'): return
@@ -390,5 +593,11 @@ class GUI(QWidget):
         self.img = utils.smart_resize(self.img, (MAX_WIDTH, MAX_HEIGHT))
         self.height, self.width = self.img.shape[:2]
             
-    def __del__(self):
-        if self.sam_thread.isRunning: self.sam_thread.quit()
\ No newline at end of file
+    # flush pending masks and stop background threads
+    def shutdown(self):
+        self.prefetcher.stop()
+        self.tiled_view.stop()
+        self.mask_saver.stop()
+        self.progress.close()
+        registry.save()
+        self.models.stop()
\ No newline at end of file
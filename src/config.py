@@ -1,23 +1,48 @@
 from pathlib import Path
-import sys
 
 _dir = Path(__file__).parent
-_model_path = _dir / 'assets' / 'models'
-_model_path.mkdir(parents=True, exist_ok=True)
-_checkpoints = list(_model_path.iterdir())
-
-MODEL_TYPE = 'vit_h'
-try:
-    SAM_CHECK_POINT = _checkpoints[2]
-    FAST_SAM_CHECK_POINT = _checkpoints[1]
-except:
-    print('Failed to find SAM and FastSAM checkpoints! ' \
-          f'Please download both and move to {_model_path}')
-    sys.exit(1)
+MODEL_DIR = _dir / 'assets' / 'models' # checkpoints are discovered here, see model_registry.py
+MODEL_DIR.mkdir(parents=True, exist_ok=True)
+MODEL_PROFILES_PATH = _dir / 'assets' / 'cache' / 'model_profiles.json' # measured latency and memory
+
+MODEL_TYPE = 'vit_h' # preferred SAM backbone when none was picked yet
 
 CONFIG_PATH = Path('./assets/user_config.json')
 
 MAX_WIDTH = 480
 MAX_HEIGHT = 480
 
-IMG_TYPES = ['*.png', '*.jpg', '*.xpm'] # maybe update later
\ No newline at end of file
+IMG_TYPES = ['*.png', '*.jpg', '*.jpeg', '*.xpm', '*.tif', '*.tiff'] # maybe update later
+RECURSIVE_INPUT = False # also list images in sub folders of the input folder
+
+# image embedding cache
+EMBEDDING_CACHE_DIR = _dir / 'assets' / 'cache' / 'embeddings'
+EMBEDDING_CACHE_RAM = 512 * 1024**2 # bytes
+EMBEDDING_CACHE_DISK = 10 * 1024**3 # bytes, about 2 MB per ViT-H image
+
+# decoded images shared by the GUI and the model workers
+IMAGE_CACHE_RAM = 256 * 1024**2 # bytes
+
+# SAM prompt decoding backend: 'onnx' uses onnxruntime with a decoder exported next to the
+# checkpoint, 'torch' always uses PyTorch, 'auto' picks onnx on CPU. Falls back to PyTorch.
+DECODER_BACKEND = 'auto'
+
+# loaded models kept resident for instant switching, least recently used are released beyond this
+MODEL_POOL_RAM = 6 * 1024**3 # bytes
+
+# number of upcoming images encoded in the background
+PREFETCH_DEPTH = 3
+PREFETCH_IDLE = 0.5 # seconds without other model jobs before a prefetch starts
+
+# annotations kept in RAM, older ones are spilled to disk
+ANNOTATION_WINDOW = 16
+
+# saved mask format: 'png', 'npz', 'rle' (COCO json) or 'npy'
+MASK_FORMAT = 'png'
+MASK_QUEUE_SIZE = 32 # masks waiting to be written before saving blocks
+
+# TIFFs with at least this many pixels are annotated in tiles at full resolution (needs tifffile)
+TILED_MIN_PIXELS = 4096 * 4096
+TILE_SIZE = 1024 # pixels, one model embedding per tile, a multiple of 16
+TILE_CACHE_RAM = 512 * 1024**2 # bytes of decoded tiles shared by the view and the model workers
+TILE_ANNOTATIONS_IN_RAM = 64 # label map tiles kept in RAM, the rest are spilled to disk
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+
+from config import EMBEDDING_CACHE_DISK
+
+
+_hashes = OrderedDict() # (path, size, mtime) -> content hash
+_hashes_lock = threading.Lock()
+
+
+# hash of the raw file bytes, so renamed or moved images still hit the cache,
+# remembered per file version so a lookup does not read the file again
+def content_hash(path, chunk_size=1 << 20, keep=4096):
+    stat = os.stat(path)
+    version = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        digest = _hashes.get(version)
+        if digest is not None:
+            _hashes.move_to_end(version)
+            return digest
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _hashes_lock:
+        _hashes[version] = digest
+        while len(_hashes) > keep:
+            _hashes.popitem(last=False)
+    return digest
+
+
+# image_key replaces the content hash when the caller already identifies the image
+def make_key(img_path, model_type, check_point, *extra, image_key=None):
+    check_point = Path(check_point)
+    parts = [image_key or content_hash(img_path), model_type, check_point.name]
+    if check_point.exists():
+        parts.append(str(check_point.stat().st_size))
+    parts.extend(str(e) for e in extra)
+    return hashlib.blake2b('|'.join(parts).encode(), digest_size=16).hexdigest()
+
+
+def _entry_bytes(entry):
+    return sum(arr.nbytes for arr in entry.values())
+
+
+class EmbeddingCache:
+    """Two-tier cache of image embeddings.
+
+    Entries are dicts of numpy arrays. The RAM tier is an LRU bounded by
+    `max_bytes`. The disk tier stores floats as fp16 and is an LRU bounded
+    by `disk_bytes`, by file modification time, which a disk hit renews.
+    Processes sharing a cache folder each keep it within the budget as far
+    as they know of its files.
+    """
+    def __init__(self, cache_dir=None, max_bytes=512 * 1024**2, disk_bytes=EMBEDDING_CACHE_DISK):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_bytes = max_bytes
+        self.disk_bytes = disk_bytes
+        if self.cache_dir: self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._ram = OrderedDict()
+        self._ram_bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None # key -> file size, oldest first, listed on first use
+        self._disk_used = 0
+
+        self.ram_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._ram.get(key)
+            if entry is not None:
+                self._ram.move_to_end(key)
+                self.ram_hits += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._add_ram(key, entry)
+            self._touch_disk(key)
+        return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._add_ram(key, entry)
+        self._write_disk(key, entry)
+
+    def contains(self, key):
+        with self._lock:
+            if key in self._ram: return True
+        path = self._disk_path(key)
+        return path is not None and path.exists()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.ram_hits + self.disk_hits + self.misses
+            return {'ram_hits': self.ram_hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'hit_rate': (self.ram_hits + self.disk_hits) / lookups if lookups else 0.0,
+                    'ram_entries': len(self._ram),
+                    'ram_bytes': self._ram_bytes}
+
+    def clear_ram(self):
+        with self._lock:
+            self._ram.clear()
+            self._ram_bytes = 0
+
+    def _add_ram(self, key, entry):
+        size = _entry_bytes(entry)
+        if size > self.max_bytes: return
+        if key in self._ram:
+            self._ram_bytes -= _entry_bytes(self._ram.pop(key))
+        self._ram[key] = entry
+        self._ram_bytes += size
+        while self._ram_bytes > self.max_bytes:
+            _, old = self._ram.popitem(last=False)
+            self._ram_bytes -= _entry_bytes(old)
+
+    def _disk_path(self, key):
+        if not self.cache_dir: return None
+        return self.cache_dir / key[:2] / f'{key}.npz'
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        if path is None or not path.exists(): return None
+        try:
+            with np.load(path) as data:
+                return {name: data[name].astype(np.float32) if data[name].dtype == np.float16 else data[name]
+                        for name in data.files}
+        except Exception as e:
+            print(f'Failed to read cached embedding {path}: {e}')
+            return None
+
+    # lists the disk tier once, callers hold the lock
+    def _disk_index(self):
+        if self._disk is None:
+            files = []
+            for path in self.cache_dir.glob('*/*.npz'):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime_ns, path.stem, stat.st_size))
+            self._disk = OrderedDict((key, size) for _, key, size in sorted(files))
+            self._disk_used = sum(self._disk.values())
+        return self._disk
+
+    def _touch_disk(self, key):
+        disk = self._disk_index()
+        if key not in disk: return
+        disk.move_to_end(key)
+        try:
+            os.utime(self._disk_path(key))
+        except OSError:
+            pass
+
+    # records a written entry and deletes the least recently used ones over the budget
+    def _add_disk(self, key, size):
+        with self._lock:
+            disk = self._disk_index()
+            self._disk_used += size - disk.pop(key, 0)
+            disk[key] = size
+            evicted = []
+            while self._disk_used > self.disk_bytes and len(disk) > 1:
+                old, old_size = disk.popitem(last=False)
+                self._disk_used -= old_size
+                evicted.append(old)
+        for old in evicted:
+            self._disk_path(old).unlink(missing_ok=True)
+
+    def _write_disk(self, key, entry):
+        path = self._disk_path(key)
+        if path is None: return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = {name: arr.astype(np.float16) if np.issubdtype(arr.dtype, np.floating) else arr
+                for name, arr in entry.items()}
+        tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'Failed to write cached embedding {path}: {e}')
+            tmp_path.unlink(missing_ok=True)
+            return
+        self._add_disk(key, path.stat().st_size)
@@ -0,0 +1,154 @@
+"""Pre-compute SAM image embeddings for a folder of images.
+
+Embeddings are written to the same store the GUI reads from, so images
+encoded here open instantly in the annotator. Images that are already in
+the store are skipped, which makes an interrupted run safe to restart.
+
+Usage:
+    python encode.py ../imgs/in --batch-size 4 --memory-budget 16
+"""
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+from pathlib import Path
+
+from config import MODEL_TYPE, EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_DISK
+from image_index import find_images
+from model_registry import registry
+
+# rough peak memory of one encoding process per backbone
+_process_memory = {'vit_b': 1.5 * 1024**3,
+                   'vit_l': 3 * 1024**3,
+                   'vit_h': 5 * 1024**3}
+
+_worker = {}
+
+
+def total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024**3
+
+
+def pool_size(model_type, memory_budget, cuda):
+    if cuda: return 1 # a single process keeps the GPU busy
+    by_memory = int(memory_budget // _process_memory.get(model_type, _process_memory['vit_h']))
+    return max(1, min(os.cpu_count() or 1, by_memory))
+
+
+def _init_worker(model_type, check_point, cache_dir, cache_bytes, cuda, threads):
+    import torch
+    from segment_anything import sam_model_registry
+    from segment_anything.utils.transforms import ResizeLongestSide
+    from embedding_cache import EmbeddingCache
+
+    torch.set_num_threads(threads)
+    sam = sam_model_registry[model_type](check_point)
+    if cuda: sam.to(device='cuda')
+    _worker['sam'] = sam
+    _worker['transform'] = ResizeLongestSide(sam.image_encoder.img_size)
+    _worker['cache'] = EmbeddingCache(cache_dir, max_bytes=0, disk_bytes=cache_bytes) # disk only
+    _worker['model_type'] = model_type
+    _worker['check_point'] = check_point
+
+
+def _encode_batch(img_paths):
+    from sam_worker import encode_images, load_image, sam_cache_key
+
+    cache = _worker['cache']
+    todo, skipped, failed = [], 0, []
+    for img_path in img_paths:
+        try:
+            key = sam_cache_key(img_path, _worker['model_type'], _worker['check_point'])
+            if cache.contains(key):
+                skipped += 1
+                continue
+            todo.append((img_path, key, load_image(img_path)))
+        except Exception as e:
+            failed.append(f'{img_path}: {e}')
+
+    if todo:
+        try:
+            entries = encode_images(_worker['sam'], _worker['transform'], [img for _, _, img in todo])
+            for (_, key, _), entry in zip(todo, entries):
+                cache.put(key, entry)
+        except Exception as e:
+            failed.extend(f'{img_path}: {e}' for img_path, _, _ in todo)
+            return len(img_paths), 0, skipped, failed
+    return len(img_paths), len(todo), skipped, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-compute SAM embeddings for a folder of images.')
+    parser.add_argument('input', type=Path, help='folder of images to encode')
+    parser.add_argument('--recursive', action='store_true', help='also encode images in sub folders')
+    parser.add_argument('--model-type', default=None, help=f'SAM backbone, defaults to {MODEL_TYPE} if available')
+    parser.add_argument('--check-point', type=Path, default=None, help='defaults to the discovered checkpoint')
+    parser.add_argument('--cache-dir', type=Path, default=EMBEDDING_CACHE_DIR)
+    parser.add_argument('--cache-size', type=float, default=EMBEDDING_CACHE_DISK / 1024**3,
+                        help='GB of disk for the cache, least recently used embeddings are deleted beyond it')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=0, help='number of processes, 0 picks from cores and memory')
+    parser.add_argument('--memory-budget', type=float, default=0, help='GB of RAM to use, 0 uses 80%% of the machine')
+    parser.add_argument('--cpu', action='store_true', help='do not use CUDA even if it is available')
+    args = parser.parse_args(argv)
+    
+    if args.check_point is None:
+        specs = [s for s in registry if s.family == 'SAM' and args.model_type in (None, s.model_type)]
+        if not specs:
+            print(f'No SAM {args.model_type or ""} checkpoint found in {registry.model_dir}')
+            return 1
+        spec = next((s for s in specs if s.model_type == MODEL_TYPE), specs[0])
+        args.model_type, args.check_point = spec.model_type, spec.check_point
+    elif args.model_type is None:
+        args.model_type = MODEL_TYPE
+
+    import torch
+    cuda = torch.cuda.is_available() and not args.cpu
+
+    img_paths = [str(p) for p in find_images(args.input, args.recursive)]
+    if not img_paths:
+        print(f'No images found in {args.input}')
+        return 1
+
+    memory_budget = args.memory_budget * 1024**3 if args.memory_budget else 0.8 * total_memory()
+    workers = args.workers or pool_size(args.model_type, memory_budget, cuda)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    batches = [img_paths[i:i+args.batch_size] for i in range(0, len(img_paths), args.batch_size)]
+    print(f'Encoding {len(img_paths)} images with {args.model_type} on '
+          f'{"cuda" if cuda else "cpu"}: {workers} processes, batch size {args.batch_size}')
+
+    done = encoded = skipped = 0
+    failures = []
+    start = time.time()
+    ctx = mp.get_context('spawn') # CUDA and torch threads do not survive fork
+    with ctx.Pool(workers, initializer=_init_worker,
+                  initargs=(args.model_type, str(args.check_point), str(args.cache_dir), args.cache_size * 1024**3, cuda, threads)) as pool:
+        try:
+            for n, n_encoded, n_skipped, failed in pool.imap_unordered(_encode_batch, batches):
+                done += n
+                encoded += n_encoded
+                skipped += n_skipped
+                failures.extend(failed)
+                elapsed = time.time() - start
+                rate = encoded / elapsed if elapsed else 0.0
+                print(f'\r[{done}/{len(img_paths)}] encoded {encoded}, skipped {skipped}, '
+                      f'failed {len(failures)} | {rate:.2f} images/s', end='', flush=True)
+        except KeyboardInterrupt:
+            pool.terminate()
+            print('\nInterrupted, run again to resume')
+            return 130
+    print()
+
+    for failure in failures:
+        print(f'Failed: {failure}')
+    elapsed = time.time() - start
+    print(f'Encoded {encoded} images in {elapsed:.1f}s ({encoded / elapsed if elapsed else 0.0:.2f} images/s)')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 from .model import FastSAM
+from .utils import build_instance_index, point_prompt_mask, lazy_point_prompt_mask, mask_integrals, box_prompt_ids
 import numpy as np
 from PIL import Image
 from typing import Optional, List, Tuple, Union
@@ -22,6 +23,7 @@ class FastSAMDecoder:
         self.iou = iou
         self.image = None
         self.image_embedding = None
+        self._tables = None
         
     def run_encoder(self, image):
         if isinstance(image,str):
@@ -58,60 +60,49 @@ class FastSAMDecoder:
         else:
             return None
 
-    def box_prompt(self, bbox):
-        assert (bbox[2] != 0 and bbox[3] != 0)
-        masks = self.image_embedding.masks.data
-        target_height = self.image.shape[0]
-        target_width = self.image.shape[1]
-        h = masks.shape[1]
-        w = masks.shape[2]
-        if h != target_height or w != target_width:
-            bbox = [
-                int(bbox[0] * w / target_width),
-                int(bbox[1] * h / target_height),
-                int(bbox[2] * w / target_width),
-                int(bbox[3] * h / target_height), ]
-        bbox[0] = round(bbox[0]) if round(bbox[0]) > 0 else 0
-        bbox[1] = round(bbox[1]) if round(bbox[1]) > 0 else 0
-        bbox[2] = round(bbox[2]) if round(bbox[2]) < w else w
-        bbox[3] = round(bbox[3]) if round(bbox[3]) < h else h
-
-        # IoUs = torch.zeros(len(masks), dtype=torch.float32)
-        bbox_area = (bbox[3] - bbox[1]) * (bbox[2] - bbox[0])
-
-        masks_area = np.sum(masks[:, bbox[1]:bbox[3], bbox[0]:bbox[2]], axis=(1, 2))
-        orig_masks_area = np.sum(masks, axis=(1, 2))
-
-        union = bbox_area + orig_masks_area - masks_area
-        IoUs = masks_area / union
-        max_iou_index = np.argmax(IoUs)
-
-        return np.array([masks[max_iou_index].cpu().numpy()])
+    def box_prompt(self, bbox=None, bboxes=None):
+        assert bbox is not None or bboxes is not None
+        if bboxes is None:
+            bboxes = [bbox]
+        tables = self.lookup_tables(integrals=True)
+        max_iou_index = box_prompt_ids(tables['integrals'], tables['areas'], bboxes, self.image.shape)
+        if tables['lazy'] is not None:
+            return tables['lazy'].select(max_iou_index)
+        return tables['masks'][max_iou_index]
 
     def point_prompt(self, points, pointlabel):  # numpy 
-
-        masks = self._format_results(self.image_embedding[0], 0)
+        tables = self.lookup_tables()
+        index_map = tables['index_map']
         target_height = self.image.shape[0]
         target_width = self.image.shape[1]
-        h = masks[0]['segmentation'].shape[0]
-        w = masks[0]['segmentation'].shape[1]
+        h, w = index_map.shape
         if h != target_height or w != target_width:
             points = [[int(point[0] * w / target_width), int(point[1] * h / target_height)] for point in points]
-        onemask = np.zeros((h, w))
-        masks = sorted(masks, key=lambda x: x['area'], reverse=True)
-        for i, annotation in enumerate(masks):
-            if type(annotation) == dict:
-                mask = annotation['segmentation']
-            else:
-                mask = annotation
-            for i, point in enumerate(points):
-                if mask[point[1], point[0]] == 1 and pointlabel[i] == 1:
-                    onemask[mask] = 1
-                if mask[point[1], point[0]] == 1 and pointlabel[i] == 0:
-                    onemask[mask] = 0
-        onemask = onemask >= 1
+        if tables['lazy'] is not None:
+            onemask = lazy_point_prompt_mask(tables['lazy'].select, index_map, points, pointlabel,
+                                             tables['lazy'].orig_shape)
+        else:
+            onemask = point_prompt_mask(tables['masks'], index_map, tables['bboxes'], points, pointlabel)
         return np.array([onemask])
     
+    # per-embedding lookup tables, rebuilt when the embedding changes
+    def lookup_tables(self, integrals=False):
+        if self._tables is None or self._tables['embedding'] is not self.image_embedding:
+            lazy = self.image_embedding.masks if hasattr(self.image_embedding.masks, 'low_res') else None
+            # with lazy masks the tables are at prototype resolution
+            masks = lazy.low_res() if lazy is not None else np.asarray(self.image_embedding.masks.data) != 0
+            index_map, areas, bboxes = build_instance_index(masks)
+            self._tables = {'embedding': self.image_embedding,
+                            'lazy': lazy,
+                            'masks': masks,
+                            'index_map': index_map,
+                            'areas': areas,
+                            'bboxes': bboxes,
+                            'integrals': None}
+        if integrals and self._tables['integrals'] is None:
+            self._tables['integrals'] = mask_integrals(self._tables['masks'])
+        return self._tables
+    
     def _format_results(self, result, filter=0):
         annotations = []
         n = len(result.masks.data)
@@ -8,6 +8,7 @@ Usage - Predict:
     model = FastSAM('last.pt')
     results = model.predict('ultralytics/assets/bus.jpg')
 """
+import time
 
 from ultralytics.yolo.cfg import get_cfg
 from ultralytics.yolo.engine.exporter import Exporter
@@ -21,11 +22,21 @@ from .predict import FastSAMPredictor
 
 class FastSAM(YOLO):
 
+    def __init__(self, model='FastSAM-x.pt', task=None):
+        super().__init__(model, task)
+        self.predictors = {}  # (device, imgsz, conf, iou) -> set up and warmed FastSAMPredictor
+        self.timings = {}  # milliseconds spent in each stage of the last prediction
+
     @smart_inference_mode()
     def predict(self, source=None, stream=False, **kwargs):
         """
         Perform prediction using the YOLO model.
 
+        The predictor for each (device, imgsz, conf, iou) is built and warmed
+        up once and reused for later images. Errors are raised to the caller.
+        The setup, inference and postprocess time of the last image are kept
+        in `timings`.
+
         Args:
             source (str | int | PIL | np.ndarray): The source of the image to make predictions on.
                           Accepts all source types accepted by the YOLO model.
@@ -45,12 +56,34 @@ class FastSAM(YOLO):
         overrides['mode'] = kwargs.get('mode', 'predict')
         assert overrides['mode'] in ['track', 'predict']
         overrides['save'] = kwargs.get('save', False)  # do not save by default if called in Python
-        self.predictor = FastSAMPredictor(overrides=overrides)
-        self.predictor.setup_model(model=self.model, verbose=False)
-        try:
-            return self.predictor(source, stream=stream)
-        except Exception as e:
-            return None
+
+        start = time.perf_counter()
+        self.predictor = self.get_predictor(overrides)
+        setup = time.perf_counter() - start
+        if stream:
+            self.timings = {'setup': setup * 1E3}
+            return self.predictor(source, stream=True)
+        results = self.predictor(source)
+        total = time.perf_counter() - start
+        postprocess = self.predictor.postprocess_time
+        self.timings = {'setup': setup * 1E3,
+                        'inference': (total - setup - postprocess) * 1E3,  # includes loading and preprocessing
+                        'postprocess': postprocess * 1E3}
+        return results
+
+    def get_predictor(self, overrides):
+        """Predictor for the configuration in overrides, set up on first use and reused afterwards."""
+        key = (str(overrides.get('device')), overrides.get('imgsz'), overrides.get('conf'), overrides.get('iou'))
+        predictor = self.predictors.get(key)
+        if predictor is None:
+            predictor = FastSAMPredictor(overrides=overrides)
+            predictor.setup_model(model=self.model, verbose=False)
+            self.predictors[key] = predictor
+        else:
+            # arguments outside of the key are cheap to change between calls
+            for name, value in overrides.items():
+                setattr(predictor.args, name, value)
+        return predictor
 
     def train(self, **kwargs):
         """Function trains models but raises an error as FastSAM models do not support training."""
@@ -1,3 +1,6 @@
+import time
+
+import numpy as np
 import torch
 
 from ultralytics.yolo.engine.results import Results
@@ -5,14 +8,112 @@ from ultralytics.yolo.utils import DEFAULT_CFG, ops
 from ultralytics.yolo.v8.detect.predict import DetectionPredictor
 from .utils import bbox_iou
 
+class LazyMasks:
+    """Masks of one result kept as mask prototypes, per detection coefficients and boxes.
+
+    Stands in for ultralytics' Masks. Full resolution masks are only built
+    for the detections a prompt selects (select), or for all of them when
+    data is read. low_res() has every mask at prototype resolution, cheap
+    enough for the per-image lookup tables.
+    """
+    def __init__(self, proto, coeffs, boxes, orig_shape, numpy=False, low_res=None):
+        self.proto = proto # (c, mh, mw)
+        self.coeffs = coeffs # (n, c)
+        self.boxes = boxes # (n, 4) xyxy in image coordinates
+        self.orig_shape = tuple(orig_shape[:2])
+        self.is_numpy = numpy # data as numpy, like Masks.numpy()
+        self._low_res = low_res
+
+    def __len__(self):
+        return len(self.coeffs)
+
+    @property
+    def shape(self):
+        return (len(self),) + self.orig_shape
+
+    # (n, h, w) bool masks at prototype resolution, without the letterbox padding
+    def low_res(self):
+        if self._low_res is None:
+            c, mh, mw = self.proto.shape
+            h, w = self.orig_shape
+            # same crop of the padding as ops.process_mask_native
+            gain = min(mh / h, mw / w)
+            pad = (mw - w * gain) / 2, (mh - h * gain) / 2
+            top, left = int(pad[1]), int(pad[0])
+            bottom, right = int(mh - pad[1]), int(mw - pad[0])
+            logits = (self.coeffs @ self.proto.float().view(c, -1)).view(-1, mh, mw)[:, top:bottom, left:right]
+            lh, lw = logits.shape[1:]
+            scale = torch.tensor([lw / w, lh / h, lw / w, lh / h], device=self.boxes.device)
+            # a sigmoid above 0.5 is a positive logit
+            self._low_res = (ops.crop_mask(logits, self.boxes * scale) > 0).cpu().numpy()
+        return self._low_res
+
+    # (k, h, w) bool full resolution masks of the detections ids
+    def select(self, ids):
+        ids = torch.as_tensor(np.asarray(ids, dtype=np.int64).reshape(-1), device=self.coeffs.device)
+        if len(ids) == 0:
+            return np.zeros((0,) + self.orig_shape, dtype=bool)
+        return self._materialize(ids).cpu().numpy() != 0
+
+    def _materialize(self, ids):
+        return ops.process_mask_native(self.proto, self.coeffs[ids], self.boxes[ids], self.orig_shape)
+
+    # every mask at full resolution, as Masks.data, for "everything" output
+    @property
+    def data(self):
+        if len(self) == 0:
+            masks = torch.zeros((0,) + self.orig_shape, device=self.coeffs.device)
+        else:
+            masks = self._materialize(torch.arange(len(self), device=self.coeffs.device))
+        return masks.cpu().numpy() if self.is_numpy else masks
+
+    def _apply(self, fn, *args, numpy=None, **kwargs):
+        return LazyMasks(getattr(self.proto, fn)(*args, **kwargs),
+                         getattr(self.coeffs, fn)(*args, **kwargs),
+                         getattr(self.boxes, fn)(*args, **kwargs),
+                         self.orig_shape,
+                         self.is_numpy if numpy is None else numpy,
+                         self._low_res)
+
+    def cpu(self):
+        return self._apply('cpu')
+
+    # prototypes stay tensors, only what data returns becomes numpy
+    def numpy(self):
+        return self._apply('cpu', numpy=True)
+
+    def cuda(self):
+        return self._apply('cuda')
+
+    def to(self, *args, **kwargs):
+        return self._apply('to', *args, **kwargs)
+
+    def __getitem__(self, idx):
+        ids = torch.arange(len(self))[idx]
+        low_res = None if self._low_res is None else self._low_res[ids.numpy()]
+        ids = ids.to(self.coeffs.device)
+        if ids.dim() == 0:
+            mask = self._materialize(ids.view(1))[0]
+            return mask.cpu().numpy() if self.is_numpy else mask
+        return LazyMasks(self.proto, self.coeffs[ids], self.boxes[ids], self.orig_shape, self.is_numpy, low_res)
+
+
 class FastSAMPredictor(DetectionPredictor):
 
     def __init__(self, cfg=DEFAULT_CFG, overrides=None, _callbacks=None):
         super().__init__(cfg, overrides, _callbacks)
         self.args.task = 'segment'
+        self.postprocess_time = 0.0  # seconds spent in postprocess on the last call
 
     def postprocess(self, preds, img, orig_imgs):
         """TODO: filter by classes."""
+        start = time.perf_counter()
+        try:
+            return self._postprocess(preds, img, orig_imgs)
+        finally:
+            self.postprocess_time = time.perf_counter() - start
+
+    def _postprocess(self, preds, img, orig_imgs):
         p = ops.non_max_suppression(preds[0],
                                     self.args.conf,
                                     self.args.iou,
@@ -46,7 +147,11 @@ class FastSAMPredictor(DetectionPredictor):
             if self.args.retina_masks:
                 if not isinstance(orig_imgs, torch.Tensor):
                     pred[:, :4] = ops.scale_boxes(img.shape[2:], pred[:, :4], orig_img.shape)
-                masks = ops.process_mask_native(proto[i], pred[:, 6:], pred[:, :4], orig_img.shape[:2])  # HWC
+                # full resolution masks are only built for the detections a prompt selects
+                result = Results(orig_img=orig_img, path=img_path, names=self.model.names, boxes=pred[:, :6])
+                result.masks = LazyMasks(proto[i], pred[:, 6:], pred[:, :4], orig_img.shape[:2])
+                results.append(result)
+                continue
             else:
                 masks = ops.process_mask(proto[i], pred[:, 6:], pred[:, :4], img.shape[2:], upsample=True)  # HWC
                 if not isinstance(orig_imgs, torch.Tensor):
@@ -4,7 +4,7 @@ import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from .utils import image_to_np_ndarray
+from .utils import image_to_np_ndarray, build_instance_index, point_prompt_mask, lazy_point_prompt_mask, mask_integrals, box_prompt_ids
 from PIL import Image
 
 
@@ -16,6 +16,25 @@ class FastSAMPrompt:
         self.device = device
         self.results = results
         self.img = image
+        self.masks = None
+        self.lazy_masks = None # predict.LazyMasks with retina_masks
+        self.index_map = None
+        self.areas = None
+        self.bboxes = None
+        self.integrals = None
+
+    # per-image lookup tables for point prompts, built once instead of per click
+    def build_index(self):
+        if not self.results or self.results[0].masks is None:
+            return
+        masks = self.results[0].masks
+        if hasattr(masks, 'low_res'):
+            # lookups at prototype resolution, selected masks are built at full resolution
+            self.lazy_masks = masks
+            self.masks = masks.low_res()
+        else:
+            self.masks = masks.data.cpu().numpy() != 0
+        self.index_map, self.areas, self.bboxes = build_instance_index(self.masks)
     
     def _segment_image(self, image, bbox):
         if isinstance(image, Image.Image):
@@ -353,67 +372,41 @@ class FastSAMPrompt:
 
         return cropped_boxes, cropped_images, not_crop, filter_id, annotations
 
+    # all boxes are matched at once against summed-area tables of the masks
     def box_prompt(self, bbox=None, bboxes=None):
         if self.results == None:
             return []
         assert bbox or bboxes
         if bboxes is None:
             bboxes = [bbox]
-        max_iou_index = []
-        for bbox in bboxes:
-            assert (bbox[2] != 0 and bbox[3] != 0)
-            masks = self.results[0].masks.data
-            target_height = self.img.shape[0]
-            target_width = self.img.shape[1]
-            h = masks.shape[1]
-            w = masks.shape[2]
-            if h != target_height or w != target_width:
-                bbox = [
-                    int(bbox[0] * w / target_width),
-                    int(bbox[1] * h / target_height),
-                    int(bbox[2] * w / target_width),
-                    int(bbox[3] * h / target_height), ]
-            bbox[0] = round(bbox[0]) if round(bbox[0]) > 0 else 0
-            bbox[1] = round(bbox[1]) if round(bbox[1]) > 0 else 0
-            bbox[2] = round(bbox[2]) if round(bbox[2]) < w else w
-            bbox[3] = round(bbox[3]) if round(bbox[3]) < h else h
-
-            # IoUs = torch.zeros(len(masks), dtype=torch.float32)
-            bbox_area = (bbox[3] - bbox[1]) * (bbox[2] - bbox[0])
-
-            masks_area = torch.sum(masks[:, bbox[1]:bbox[3], bbox[0]:bbox[2]], dim=(1, 2))
-            orig_masks_area = torch.sum(masks, dim=(1, 2))
-
-            union = bbox_area + orig_masks_area - masks_area
-            IoUs = masks_area / union
-            max_iou_index.append(int(torch.argmax(IoUs)))
-        max_iou_index = list(set(max_iou_index))
-        return np.array(masks[max_iou_index].cpu().numpy())
+        if self.index_map is None:
+            self.build_index()
+        if self.index_map is None:
+            return []
+        if self.integrals is None:
+            self.integrals = mask_integrals(self.masks)
+        max_iou_index = box_prompt_ids(self.integrals, self.areas, bboxes, self.img.shape)
+        if self.lazy_masks is not None:
+            return self.lazy_masks.select(max_iou_index)
+        return self.masks[max_iou_index]
 
     def point_prompt(self, points, pointlabel):  # numpy 
         if self.results == None:
             return []
-        masks = self._format_results(self.results[0], 0)
+        if self.index_map is None:
+            self.build_index()
+        if self.index_map is None:
+            return []
         target_height = self.img.shape[0]
         target_width = self.img.shape[1]
-        h = masks[0]['segmentation'].shape[0]
-        w = masks[0]['segmentation'].shape[1]
+        h, w = self.index_map.shape
         if h != target_height or w != target_width:
             points = [[int(point[0] * w / target_width), int(point[1] * h / target_height)] for point in points]
-        onemask = np.zeros((h, w))
-        masks = sorted(masks, key=lambda x: x['area'])
-        for i, annotation in enumerate(masks):
-            if type(annotation) == dict:
-                mask = annotation['segmentation']
-            else:
-                mask = annotation
-            for i, point in enumerate(points):
-                if mask[point[1], point[0]] == 1 and pointlabel[i] == 1:
-                    onemask[mask] = 1
-                    return np.array([onemask])
-                if mask[point[1], point[0]] == 1 and pointlabel[i] == 0:
-                    onemask[mask] = 0
-        onemask = onemask >= 1
+        if self.lazy_masks is not None:
+            onemask = lazy_point_prompt_mask(self.lazy_masks.select, self.index_map, points, pointlabel,
+                                             self.lazy_masks.orig_shape)
+        else:
+            onemask = point_prompt_mask(self.masks, self.index_map, self.bboxes, points, pointlabel)
         return np.array([onemask])
 
 
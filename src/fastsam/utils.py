@@ -1,3 +1,4 @@
+import cv2
 import numpy as np
 import torch
 from PIL import Image
@@ -84,3 +85,135 @@ def image_to_np_ndarray(image):
     elif type(image) is np.ndarray:
         return image
     return None
+
+
+def build_instance_index(masks):
+    '''Precompute lookup tables so point prompts do not scan every mask.
+    Args:
+    masks: (n, h, w) masks
+    Returns:
+    index_map: (h, w) id of the smallest mask covering each pixel, -1 if none
+    areas: (n, ) mask areas
+    bboxes: (n, 4) xyxy mask bounding boxes, exclusive on x2 and y2
+    '''
+    masks = masks.astype(bool, copy=False)
+    n, h, w = masks.shape
+    areas = masks.sum(axis=(1, 2))
+    if n == 0:
+        return np.full((h, w), -1, dtype=np.int32), areas, np.zeros((0, 4), dtype=np.int64)
+
+    # the first covering mask in ascending area order is the smallest one
+    order = np.argsort(areas, kind='stable')
+    sorted_masks = masks[order]
+    first = sorted_masks.argmax(axis=0)
+    covered = np.take_along_axis(sorted_masks, first[None], axis=0)[0]
+    index_map = np.where(covered, order[first], -1).astype(np.int32)
+
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    bboxes = np.stack([cols.argmax(axis=1),
+                       rows.argmax(axis=1),
+                       w - cols[:, ::-1].argmax(axis=1),
+                       h - rows[:, ::-1].argmax(axis=1)], axis=1)
+    bboxes[areas == 0] = 0
+    return index_map, areas, bboxes
+
+
+def point_prompt_ids(index_map, points, pointlabel):
+    '''Masks selected by positive and negative points.
+    Args:
+    index_map: (h, w) from build_instance_index
+    points: (k, 2) xy points in index_map coordinates
+    pointlabel: (k, ) 1 for positive and 0 for negative points
+    Returns:
+    positive, negative: ids of the smallest mask under each point, a mask
+    hit by both counts as positive
+    '''
+    h, w = index_map.shape
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    pointlabel = np.asarray(pointlabel).reshape(-1)
+    ids = index_map[points[:, 1].clip(0, h - 1), points[:, 0].clip(0, w - 1)]
+    positive = np.unique(ids[(pointlabel == 1) & (ids >= 0)])
+    negative = np.setdiff1d(ids[(pointlabel == 0) & (ids >= 0)], positive)
+    return positive, negative
+
+
+def point_prompt_mask(masks, index_map, bboxes, points, pointlabel):
+    '''Union of the masks under positive points, without the pixels owned by
+    (smallest covered by) the masks under negative points.'''
+    positive, negative = point_prompt_ids(index_map, points, pointlabel)
+    onemask = np.zeros(index_map.shape, dtype=bool)
+    for i in positive:
+        x1, y1, x2, y2 = bboxes[i]
+        onemask[y1:y2, x1:x2] |= masks[i, y1:y2, x1:x2]
+    if len(negative):
+        onemask &= ~np.isin(index_map, negative)
+    return onemask
+
+
+def lazy_point_prompt_mask(select, index_map, points, pointlabel, shape):
+    '''point_prompt_mask for masks built at full resolution on demand.
+    Args:
+    select: ids -> (k, height, width) full resolution masks of those ids
+    index_map: (h, w) from build_instance_index of low resolution masks
+    points: (k, 2) xy points in index_map coordinates
+    shape: (height, width) of the full resolution masks
+    '''
+    positive, negative = point_prompt_ids(index_map, points, pointlabel)
+    onemask = select(positive).any(axis=0) if len(positive) else np.zeros(shape, dtype=bool)
+    if len(negative):
+        # negative mask pixels where, at low resolution, a negative mask is the smallest
+        owned = cv2.resize(np.isin(index_map, negative).astype(np.uint8), (shape[1], shape[0]),
+                           interpolation=cv2.INTER_NEAREST)
+        onemask &= ~(select(negative).any(axis=0) & (owned != 0))
+    return onemask
+
+
+def mask_integrals(masks):
+    '''Summed-area tables of all masks, computed once per image.
+    Args:
+    masks: (n, h, w) masks
+    Returns:
+    integrals: (n, h + 1, w + 1) with integrals[i, y, x] = masks[i, :y, :x].sum()
+    '''
+    n, h, w = masks.shape
+    integrals = np.zeros((n, h + 1, w + 1), dtype=np.int32)
+    np.cumsum(masks, axis=1, dtype=np.int32, out=integrals[:, 1:, 1:])
+    np.cumsum(integrals[:, 1:, 1:], axis=2, out=integrals[:, 1:, 1:])
+    return integrals
+
+
+def box_mask_iou(integrals, areas, boxes):
+    '''IoU of every box against every mask in O(n) per box.
+    Args:
+    integrals: (n, h + 1, w + 1) from mask_integrals
+    areas: (n, ) mask areas
+    boxes: (b, 4) xyxy boxes in mask coordinates, clipped to the mask size
+    Returns:
+    ious: (b, n)
+    '''
+    x1, y1, x2, y2 = np.asarray(boxes, dtype=np.int64).T
+    inside = integrals[:, y2, x2] - integrals[:, y1, x2] - integrals[:, y2, x1] + integrals[:, y1, x1]
+    inside = inside.T.astype(np.float64) # (b, n)
+    box_areas = ((x2 - x1) * (y2 - y1)).astype(np.float64)
+    union = box_areas[:, None] + areas[None, :] - inside
+    return inside / np.maximum(union, 1)
+
+
+def box_prompt_ids(integrals, areas, boxes, image_shape):
+    '''Ids of the best matching mask for each box, without duplicates.
+    Args:
+    boxes: (b, 4) xyxy boxes in image coordinates
+    image_shape: (height, width) of the image the boxes were drawn on
+    '''
+    h, w = integrals.shape[1] - 1, integrals.shape[2] - 1
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    assert (boxes[:, 2] != 0).all() and (boxes[:, 3] != 0).all()
+    target_height, target_width = image_shape[:2]
+    if h != target_height or w != target_width:
+        boxes = np.trunc(boxes * np.array([w / target_width, h / target_height] * 2))
+    boxes = np.round(boxes).astype(np.int64)
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+    ious = box_mask_iou(integrals, areas, boxes)
+    return np.unique(ious.argmax(axis=1))
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import cv2
+from PIL import Image
+
+from config import IMAGE_CACHE_RAM, TILED_MIN_PIXELS
+from utils import smart_resize
+from tiled_image import is_tiff, tiff_size, open_tiled
+
+_reduced_flags = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                  (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2))
+_jpeg_suffixes = ('.jpg', '.jpeg')
+
+
+# (height, width) as cv2.imread would return it, read from the header only
+def image_size(img_path):
+    # PIL refuses very large TIFFs, tifffile only reads their header
+    size = tiff_size(img_path) if is_tiff(img_path) else None
+    if size is not None: return size
+    try:
+        with Image.open(img_path) as img:
+            width, height = img.size
+            if img.getexif().get(0x0112, 1) in (5, 6, 7, 8): # EXIF orientation with a 90 degree turn
+                width, height = height, width
+    except Exception:
+        img = cv2.imread(str(img_path))
+        if img is None: raise IOError(f'Failed to read image {img_path}')
+        height, width = img.shape[:2]
+    return height, width
+
+
+# large TIFFs are annotated tile by tile at full resolution instead of as one working copy
+def use_tiles(img_path):
+    if not is_tiff(img_path): return False
+    size = tiff_size(img_path)
+    return size is not None and size[0] * size[1] >= TILED_MIN_PIXELS
+
+
+def decode_image(img_path, max_size=None):
+    """Decode an image as BGR, already shrunk to fit max_size (width, height).
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale when that is still at least
+    as large as the working copy, which skips most of the decoding work.
+    Tiled images come from the smallest pyramid level that is large enough.
+    """
+    if max_size and use_tiles(img_path):
+        return open_tiled(img_path).overview(max_size)
+    img_path = str(img_path)
+    flags = cv2.IMREAD_COLOR
+    if max_size and Path(img_path).suffix.lower() in _jpeg_suffixes:
+        height, width = image_size(img_path)
+        scale = min(max_size[0] / width, max_size[1] / height)
+        for factor, reduced in _reduced_flags:
+            if scale * factor <= 1:
+                flags = reduced
+                break
+    img = cv2.imread(img_path, flags)
+    if img is None: raise IOError(f'Failed to read image {img_path}')
+    if max_size: img = smart_resize(img, max_size)
+    return img
+
+
+class ImageCache:
+    """LRU cache of decoded images shared by the GUI and the model workers.
+
+    Images are keyed by path and requested size and are returned read-only,
+    so callers must copy before modifying them.
+    """
+    def __init__(self, max_bytes=IMAGE_CACHE_RAM):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, img_path, max_size=None):
+        key = (str(img_path), tuple(max_size) if max_size else None)
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return img
+            self.misses += 1
+
+        img = decode_image(img_path, max_size)
+        img.flags.writeable = False
+        with self._lock:
+            if key not in self._images and img.nbytes <= self.max_bytes:
+                self._images[key] = img
+                self._bytes += img.nbytes
+                while self._bytes > self.max_bytes:
+                    _, old = self._images.popitem(last=False)
+                    self._bytes -= old.nbytes
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+
+image_cache = ImageCache()
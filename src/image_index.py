@@ -0,0 +1,169 @@
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from config import IMG_TYPES
+
+IMG_SUFFIXES = {t.lstrip('*').lower() for t in IMG_TYPES}
+
+# leading bytes of each supported format
+_magic = {'.png': (b'\x89PNG\r\n\x1a\n',),
+          '.jpg': (b'\xff\xd8\xff',),
+          '.jpeg': (b'\xff\xd8\xff',),
+          '.xpm': (b'/* XPM */',),
+          '.tif': (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'),
+          '.tiff': (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')}
+
+
+def natural_key(path):
+    name = str(path).casefold()
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)], str(path)
+
+
+def has_image_magic(path):
+    signatures = _magic.get(Path(path).suffix.lower())
+    if signatures is None: return True
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(16)
+    except OSError:
+        return False
+    return head.startswith(signatures)
+
+
+# yields (image path, None) for images and (folder, mtime_ns) for every folder scanned
+def scan_images(in_dir, recursive=False, check_magic=True):
+    stack = [str(in_dir)]
+    while stack:
+        folder = stack.pop()
+        try:
+            yield Path(folder), os.stat(folder).st_mtime_ns
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive: stack.append(entry.path)
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() not in IMG_SUFFIXES: continue
+                    if check_magic and not has_image_magic(entry.path): continue
+                    yield Path(entry.path), None
+        except OSError as e:
+            print(f'Failed to list {folder}: {e}')
+
+
+def find_images(in_dir, recursive=False, check_magic=True):
+    return sorted((p for p, mtime in scan_images(in_dir, recursive, check_magic) if mtime is None), key=natural_key)
+
+
+class ImageIndex(QObject):
+    """Image files of an input folder, in natural order.
+
+    The folder is listed on a background thread. File names are listed and
+    sorted first, then the candidates are checked in that order, so images
+    are available as soon as they are checked and always form a prefix of
+    the final list: indices never change and no image is skipped when the
+    user moves on early. `finished` is emitted once the listing is complete.
+    A snapshot of the listing is kept in `snapshot_dir` and reused, without
+    any signals, while none of the listed folders changed.
+    """
+    found = pyqtSignal(int) # number of images listed so far
+    finished = pyqtSignal()
+    snapshot_name = '.image_list.json'
+
+    def __init__(self, in_dir, snapshot_dir=None, recursive=False, check_magic=True):
+        super().__init__()
+        self.in_dir = Path(in_dir)
+        self.recursive = recursive
+        self.check_magic = check_magic
+        self.snapshot_path = Path(snapshot_dir) / self.snapshot_name if snapshot_dir else None
+        self.complete = False
+
+        self._paths = []
+        self._positions = None
+        self._lock = threading.Lock()
+        self._first = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._load_snapshot():
+            self.complete = True
+            self._first.set()
+            return
+        self._thread = threading.Thread(target=self._run, name='image-index', daemon=True)
+        self._thread.start()
+
+    # block until at least one image is known or the listing is complete
+    def wait_first(self, timeout=None):
+        self._first.wait(timeout)
+
+    def wait(self):
+        if self._thread: self._thread.join()
+
+    def index(self, path):
+        with self._lock:
+            if self._positions is None:
+                self._positions = {str(p): i for i, p in enumerate(self._paths)}
+            return self._positions[str(path)]
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, idx):
+        return self._paths[idx]
+
+    def __iter__(self):
+        return iter(list(self._paths))
+
+    def _run(self):
+        # listing names is cheap, opening every file for its magic is not
+        folders, candidates = {}, []
+        for path, mtime in scan_images(self.in_dir, self.recursive, check_magic=False):
+            if mtime is not None: folders[str(path)] = mtime
+            else: candidates.append(path)
+        candidates.sort(key=natural_key)
+
+        for path in candidates:
+            if self.check_magic and not has_image_magic(path): continue
+            with self._lock:
+                self._paths.append(path)
+                self._positions = None
+            if len(self._paths) == 1: self._first.set()
+            if len(self._paths) % 1000 == 1: self.found.emit(len(self._paths))
+
+        self._save_snapshot(folders, self._paths)
+        self.complete = True
+        self._first.set()
+        self.found.emit(len(self._paths))
+        self.finished.emit()
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not self.snapshot_path.exists(): return False
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                data = json.load(f)
+            if (data['in_dir'], data['recursive'], data['check_magic']) != \
+                    (str(self.in_dir), self.recursive, self.check_magic):
+                return False
+            for folder, mtime in data['folders'].items():
+                if os.stat(folder).st_mtime_ns != mtime: return False
+        except (OSError, ValueError, KeyError):
+            return False
+        self._paths = [Path(p) for p in data['paths']]
+        return True
+
+    def _save_snapshot(self, folders, paths):
+        if not self.snapshot_path: return
+        data = {'in_dir': str(self.in_dir),
+                'recursive': self.recursive,
+                'check_magic': self.check_magic,
+                'folders': folders,
+                'paths': [str(p) for p in paths]}
+        tmp_path = self.snapshot_path.with_name(f'.{self.snapshot_path.name}.tmp')
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            print(f'Failed to save image list snapshot: {e}')
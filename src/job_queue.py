@@ -0,0 +1,110 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+class Job:
+    """A request for the model worker.
+
+    `key` decides coalescing: a newer job with the same key replaces a
+    pending one, jobs without a key are never coalesced. Cancellation is
+    cooperative, the worker checks it before running a job and before
+    reporting its result.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, kind, *args, key=None, callback=None, **kwargs):
+        self.id = next(Job._ids)
+        self.kind = kind
+        self.key = self.id if key is None else key
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def __repr__(self):
+        return f'Job({self.id}, {self.kind})'
+
+
+class JobQueue:
+    # pending jobs of these kinds are stale once a job of the given kind arrives
+    supersedes = {'config_model': ('config_model', 'set_image', 'set_tile', 'predict', 'prefetch'),
+                  'set_image': ('set_image', 'set_tile', 'predict', 'prefetch'),
+                  'set_tile': ('set_tile', 'prefetch'), # predictions carry their own tile
+                  'release': ('config_model', 'set_image', 'set_tile', 'predict', 'prefetch')}
+    # kinds that only run once no other job is pending and none ran for `idle` seconds
+    background = ('prefetch',)
+
+    def __init__(self, idle=0.0):
+        self.idle = idle
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._foreground_at = 0.0 # when the last foreground job finished
+        self.current = None
+
+    def put(self, job):
+        with self._lock:
+            for kind in self.supersedes.get(job.kind, ()):
+                self._cancel(kind)
+            old = self._pending.pop(job.key, None)
+            if old is not None: old.cancel()
+            self._pending[job.key] = job
+            # results of a running job that is now stale are dropped too
+            if self.current is not None and \
+                    (self.current.key == job.key or self.current.kind in self.supersedes.get(job.kind, ())):
+                self.current.cancel()
+        return job
+
+    # oldest foreground job, a background job once the foreground has been idle long enough
+    def pop(self):
+        with self._lock:
+            if self.current is not None and self.current.kind not in self.background:
+                self._foreground_at = time.monotonic()
+            for key in [key for key, job in self._pending.items() if job.cancelled]:
+                del self._pending[key]
+            jobs = self._pending.values()
+            job = next((job for job in jobs if job.kind not in self.background), None)
+            if job is None and self._idle_for() >= self.idle: job = next(iter(jobs), None)
+            if job is not None: del self._pending[job.key]
+            self.current = job
+            return job
+
+    # seconds until a pending background job may run, None when there is none
+    def background_delay(self):
+        with self._lock:
+            if not self._pending: return None
+            return max(self.idle - self._idle_for(), 0.0)
+
+    # whether a job that is not a background one is waiting
+    def has_foreground(self):
+        with self._lock:
+            return any(job.kind not in self.background and not job.cancelled for job in self._pending.values())
+
+    def _idle_for(self):
+        return time.monotonic() - self._foreground_at
+
+    def cancel(self, kind=None):
+        with self._lock:
+            self._cancel(kind)
+            if self.current is not None and kind in (None, self.current.kind):
+                self.current.cancel()
+
+    def _cancel(self, kind):
+        for key, job in list(self._pending.items()):
+            if kind is None or job.kind == kind:
+                job.cancel()
+                del self._pending[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
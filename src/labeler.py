@@ -1,9 +1,14 @@
+import math
 import numpy as np
 import cv2
-from PyQt5.QtCore import QObject
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
 from enum import Enum
 import utils
-from config import MAX_HEIGHT, MAX_WIDTH
+from job_queue import JobQueue
+from config import MAX_HEIGHT, MAX_WIDTH, ANNOTATION_WINDOW, TILE_SIZE, TILE_ANNOTATIONS_IN_RAM
 
 class SegmentMode(Enum):
     SINGLE_POINT = 1
@@ -11,85 +16,541 @@ class SegmentMode(Enum):
     BOX = 3
 
 
+# label value -> display color lookup table, shared by all annotations
+class Palette:
+    def __init__(self):
+        self.colors = np.zeros((256, 3), dtype=np.uint8) # 0 is background
+        self.version = 0 # bumped whenever a color changes
+    
+    def set_color(self, value, color):
+        if value >= len(self.colors):
+            colors = np.zeros((max(value + 1, 2 * len(self.colors)), 3), dtype=np.uint8)
+            colors[:len(self.colors)] = self.colors
+            self.colors = colors
+        rgb = utils.hex_to_rgb(color)
+        if tuple(self.colors[value]) == rgb: return
+        self.colors[value] = rgb
+        self.version += 1
+    
+    def apply(self, label_map, out=None):
+        return np.take(self.colors, label_map, axis=0, out=out) #(h, w, 3)
+
+
+# (x, y, w, h) bounding box of a boolean mask, None if it is empty
+def mask_rect(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0: return None
+    cols = np.flatnonzero(mask[rows[0]:rows[-1]+1].any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+
+
+def union_rect(a, b):
+    if a is None: return b
+    if b is None: return a
+    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def _roi(rect):
+    x, y, w, h = rect
+    return slice(y, y + h), slice(x, x + w)
+
+
 class Annotation:
-    def __init__(self, input_size, output_size):
+    """Label map of one image at working size, with its colored display copy.
+
+    Edits only touch the bounding box of the new mask and return it as a
+    dirty rect (x, y, w, h). Rects since the last `take_dirty` are merged so
+    a view can repaint just that region.
+    """
+    def __init__(self, input_size, output_size, palette=None):
         self.height, self.width = input_size
         self.out_height, self.out_width = output_size
+        self.palette = palette if palette is not None else Palette()
+        self.object_base = None # label map before the object being refined
+        self.object_rect = None # area the object being refined covers
+        self.display = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self._display_version = None # palette version the display was rendered with
+        self.dirty = None
         self.clear_mask()
 
-    def append(self, new_mask, label):
-        new_mask_labeled = np.where(new_mask, label['value'], new_mask)
-        self.out_mask = np.where(new_mask_labeled, new_mask_labeled, self.out_mask)
-
-        color = label['color'].lstrip('#')
-        color = np.array(tuple(int(color[i:i+2], 16) for i in (0, 2, 4))) # hex to [r,g,b]
-
-        mask_image = new_mask.reshape(self.height, self.width, 1) * color.reshape(1, 1, -1) #(h, w, 3)
-        self.display_mask = np.where(mask_image, mask_image, self.display_mask)
-        self.display_mask = self.display_mask.clip(0, 255).astype("uint8")
+    def append(self, new_mask, label, rect=None):
+        value = label['value']
+        self.palette.set_color(value, label['color'])
+        if value > np.iinfo(self.out_mask.dtype).max:
+            self.out_mask = self.out_mask.astype(np.uint16)
+        new_mask = new_mask.reshape(self.height, self.width)
+        if rect is None: rect = mask_rect(new_mask)
+        if rect is None: return None
+        
+        roi = _roi(rect)
+        self.out_mask[roi][new_mask[roi].astype(bool, copy=False)] = value
+        self._render(rect)
+        return rect
+    
+    # an object refined over several decodes replaces its previous mask each time
+    def begin_object(self):
+        self.object_base = self.out_mask.copy()
+        self.object_rect = None
+    
+    def update_object(self, new_mask, label):
+        old_rect = None
+        if self.object_base is not None and self.object_rect is not None:
+            old_rect = self.object_rect
+            roi = _roi(old_rect)
+            self.out_mask[roi] = self.object_base[roi]
+        rect = self.append(new_mask, label)
+        if old_rect is not None: self._render(old_rect)
+        self.object_rect = rect
+        return union_rect(old_rect, rect)
+    
+    def end_object(self):
+        self.object_base = None
+        self.object_rect = None
         
+    # nearest neighbour so label values are never blended
     def get_mask(self):
-        return cv2.resize(self.out_mask, (self.out_width, self.out_height))
+        return cv2.resize(self.out_mask, (self.out_width, self.out_height), interpolation=cv2.INTER_NEAREST_EXACT)
+
+    def get_display_mask(self):
+        if self._display_version != self.palette.version:
+            self._render((0, 0, self.width, self.height))
+        return self.display
 
     def get_mask_image(self):
-        return utils.np_to_qt(self.display_mask)
+        return utils.np_to_qt(self.get_display_mask())
+    
+    # merged rect of every change since the last call, None if nothing changed
+    def take_dirty(self):
+        rect, self.dirty = self.dirty, None
+        return rect
+    
+    # load a full resolution label map, e.g. a previously saved mask
+    def set_mask(self, mask):
+        self.set_label_map(cv2.resize(mask, (self.width, self.height), interpolation=cv2.INTER_NEAREST_EXACT))
+    
+    def set_label_map(self, label_map):
+        self.end_object()
+        self.out_mask = label_map
+        self._render((0, 0, self.width, self.height))
     
     def clear_mask(self):
-        self.out_mask = np.zeros((self.height, self.width))
-        self.display_mask = np.zeros((self.height, self.width, 3))
+        # uint8 label map, promoted to uint16 once a label value exceeds 255
+        self.set_label_map(np.zeros((self.height, self.width), dtype=np.uint8))
+
+    # a color change since the last render invalidates the whole display
+    def _render(self, rect):
+        if self._display_version != self.palette.version: rect = (0, 0, self.width, self.height)
+        roi = _roi(rect)
+        self.palette.apply(self.out_mask[roi], out=self.display[roi])
+        self._display_version = self.palette.version
+        self.dirty = union_rect(self.dirty, rect)
+
+    
+class AnnotationStore:
+    """Annotations by image path, keeping only the most recently used in RAM.
 
+    Older annotations are spilled to compressed files in a temporary folder
+    and loaded back when they are indexed again.
+    """
+    def __init__(self, palette, max_in_memory=ANNOTATION_WINDOW):
+        self.palette = palette
+        self.max_in_memory = max(1, max_in_memory)
+        self._ram = OrderedDict() # key -> Annotation
+        self._spilled = {} # key -> (path or None if empty, input size, output size)
+        self._dir = None
+        self._files = 0
+    
+    def __len__(self):
+        return len(self._ram) + len(self._spilled)
+    
+    def __contains__(self, key):
+        return key in self._ram or key in self._spilled
+    
+    def __getitem__(self, key):
+        if key in self._ram:
+            self._ram.move_to_end(key)
+            return self._ram[key]
+        if key not in self._spilled: raise KeyError(key)
+        
+        annotation = self._load(key)
+        self[key] = annotation
+        return annotation
+    
+    def __setitem__(self, key, annotation):
+        self._ram.pop(key, None)
+        self._spilled.pop(key, None)
+        self._ram[key] = annotation
+        while len(self._ram) > self.max_in_memory:
+            self._spill(*self._ram.popitem(last=False))
     
+    def _spill(self, key, annotation):
+        sizes = ((annotation.height, annotation.width), (annotation.out_height, annotation.out_width))
+        if not annotation.out_mask.any():
+            self._spilled[key] = (None, *sizes)
+            return
+        if self._dir is None:
+            self._dir = tempfile.TemporaryDirectory(prefix='annotations_')
+        self._files += 1
+        path = Path(self._dir.name) / f'{self._files}.npz'
+        np.savez_compressed(path, out_mask=annotation.out_mask)
+        self._spilled[key] = (path, *sizes)
+    
+    def _load(self, key):
+        path, input_size, output_size = self._spilled.pop(key)
+        annotation = Annotation(input_size, output_size, self.palette)
+        if path is not None:
+            with np.load(path) as data:
+                annotation.set_label_map(data['out_mask'])
+            path.unlink()
+        return annotation
+
+
+class TiledAnnotation:
+    """Full resolution label map of an image annotated in tiles.
+
+    Each tile is an Annotation of its own, created on its first edit or read
+    from the saved label map when first shown, and kept in an AnnotationStore
+    so only the most recently used tiles stay in RAM. Rects are in full
+    resolution image coordinates.
+    """
+    def __init__(self, image_size, palette=None, saved=None, tile_size=TILE_SIZE):
+        self.height, self.width = image_size
+        self.tile_size = tile_size
+        self.palette = palette if palette is not None else Palette()
+        self.saved = saved # label map saved earlier, an array or a tiled_image.TiffRegions
+        self.dtype = np.uint8 if saved is None else np.dtype(saved.dtype)
+        self.tiles = AnnotationStore(self.palette, TILE_ANNOTATIONS_IN_RAM)
+        self._empty = set() # tiles known to have no saved labels
+        self._shrunk = OrderedDict() # (level, tx, ty) -> display of the tiles it covers, shrunk
+        self._shrunk_version = self.palette.version
+        self.object_tile = None
+        self.dirty = None
+
+    # (columns, rows) of the tile grid
+    def grid(self):
+        return math.ceil(self.width / self.tile_size), math.ceil(self.height / self.tile_size)
+
+    def tile_rect(self, tx, ty):
+        x, y = tx * self.tile_size, ty * self.tile_size
+        return x, y, min(self.tile_size, self.width - x), min(self.tile_size, self.height - y)
+
+    def tile_at(self, x, y):
+        cols, rows = self.grid()
+        return min(max(int(x) // self.tile_size, 0), cols - 1), min(max(int(y) // self.tile_size, 0), rows - 1)
+
+    # Annotation of a tile, None for a tile without any labels unless create=True
+    def tile(self, tx, ty, create=True):
+        key = (tx, ty)
+        if key in self.tiles: return self.tiles[key]
+        label_map = self._read_saved(key)
+        if label_map is None and not create: return None
+        x, y, w, h = self.tile_rect(tx, ty)
+        annotation = Annotation((h, w), (h, w), self.palette)
+        if label_map is not None: annotation.set_label_map(label_map)
+        self.tiles[key] = annotation
+        return annotation
+
+    # label map of a tile without keeping it in RAM, None if it has no labels
+    def label_map(self, tx, ty):
+        if (tx, ty) in self.tiles: return self.tiles[(tx, ty)].out_mask
+        return self._read_saved((tx, ty))
+
+    def _read_saved(self, key):
+        if self.saved is None or key in self._empty: return None
+        x, y, w, h = self.tile_rect(*key)
+        if isinstance(self.saved, np.ndarray):
+            label_map = self.saved[y:y + h, x:x + w].copy()
+        else:
+            label_map = self.saved.region(x, y, w, h)
+        if not label_map.any():
+            self._empty.add(key)
+            return None
+        return label_map
+
+    # edits of one tile, e.g. edits(tx, ty).append(mask, label) with a mask of the tile's size
+    def edits(self, tx, ty):
+        return TileEdits(self, tx, ty)
+
+    def mark_dirty(self, key, rect, value=0):
+        if value > 255: self.dtype = np.uint16
+        if rect is None: return
+        x, y = key[0] * self.tile_size, key[1] * self.tile_size
+        rect = (rect[0] + x, rect[1] + y, rect[2], rect[3])
+        self.dirty = union_rect(self.dirty, rect)
+        # shrunk displays covering the edit are rebuilt on their next use
+        for level, tx, ty in list(self._shrunk):
+            span = self.tile_size << level
+            if tx * span < rect[0] + rect[2] and rect[0] < (tx + 1) * span and \
+                    ty * span < rect[1] + rect[3] and rect[1] < (ty + 1) * span:
+                del self._shrunk[(level, tx, ty)]
+
+    def take_dirty(self):
+        rect, self.dirty = self.dirty, None
+        return rect
+
+    # display of tile (tx, ty) of pyramid level `level`, None where nothing is labeled
+    def display_tile(self, level, tx, ty, keep=64):
+        if level == 0:
+            annotation = self.tile(tx, ty, create=False)
+            return None if annotation is None else annotation.get_display_mask()
+        if self._shrunk_version != self.palette.version:
+            self._shrunk.clear()
+            self._shrunk_version = self.palette.version
+        key = (level, tx, ty)
+        if key in self._shrunk:
+            self._shrunk.move_to_end(key)
+            return self._shrunk[key]
+
+        step = 1 << level
+        span = self.tile_size * step
+        x0, y0 = tx * span, ty * span
+        width = min(self.tile_size, math.ceil(self.width / step) - tx * self.tile_size)
+        height = min(self.tile_size, math.ceil(self.height / step) - ty * self.tile_size)
+        display = None
+        cols, rows = self.grid()
+        for j in range(ty * step, min((ty + 1) * step, rows)):
+            for i in range(tx * step, min((tx + 1) * step, cols)):
+                annotation = self.tile(i, j, create=False)
+                if annotation is None: continue
+                if display is None: display = np.zeros((height, width, 3), dtype=np.uint8)
+                part = annotation.get_display_mask()[::step, ::step]
+                top, left = (j * self.tile_size - y0) // step, (i * self.tile_size - x0) // step
+                display[top:top + part.shape[0], left:left + part.shape[1]] = part
+        self._shrunk[key] = display
+        while len(self._shrunk) > keep:
+            self._shrunk.popitem(last=False)
+        return display
+
+    # pixels per label value over the whole image
+    def label_counts(self):
+        counts = np.zeros(1, dtype=np.int64)
+        cols, rows = self.grid()
+        for ty in range(rows):
+            for tx in range(cols):
+                label_map = self.label_map(tx, ty)
+                if label_map is None: continue
+                tile_counts = np.bincount(label_map.ravel())
+                if len(tile_counts) > len(counts): counts = np.pad(counts, (0, len(tile_counts) - len(counts)))
+                counts[:len(tile_counts)] += tile_counts
+        return counts
+
+    def end_object(self):
+        if self.object_tile is not None and self.object_tile in self.tiles:
+            self.tiles[self.object_tile].end_object()
+        self.object_tile = None
+
+    def clear_mask(self):
+        self.saved = None
+        self.dtype = np.uint8
+        self.tiles = AnnotationStore(self.palette, TILE_ANNOTATIONS_IN_RAM)
+        self._empty.clear()
+        self._shrunk.clear()
+        self.object_tile = None
+        self.dirty = (0, 0, self.width, self.height)
+
+
+class TileEdits:
+    # the tile is looked up on every edit, it may have been spilled since the edit was requested
+    def __init__(self, tiled, tx, ty):
+        self.tiled = tiled
+        self.key = (tx, ty)
+
+    def append(self, new_mask, label):
+        rect = self.tiled.tile(*self.key).append(new_mask, label)
+        self.tiled.mark_dirty(self.key, rect, label['value'])
+        return rect
+
+    def begin_object(self):
+        self.tiled.end_object()
+        self.tiled.tile(*self.key).begin_object()
+        self.tiled.object_tile = self.key
+
+    def update_object(self, new_mask, label):
+        rect = self.tiled.tile(*self.key).update_object(new_mask, label)
+        self.tiled.mark_dirty(self.key, rect, label['value'])
+        return rect
+
+    def end_object(self):
+        self.tiled.end_object()
 
 
 class Labeler(QObject):
-    def __init__(self, sam, in_size, out_size):
+    mask_updated = pyqtSignal()
+    failed = pyqtSignal(str) # message of a failed model job
+    
+    # annotations are keyed by image path, mask_loader(img_path) returns
+    # the saved full resolution mask of an image or None
+    # tiled=True annotates the image in tiles at its full size out_size
+    def __init__(self, sam, img_path, in_size, out_size, mask_loader=None, tiled=False):
         super().__init__()
-        self.sam = sam
+        self.sam = None
+        self.update_sam(sam)
 
-        self.anno_idx = 0
-        self.annotations = [Annotation(in_size, out_size)]
+        self.anno_key = img_path
+        self.object_id = None # object being refined, None until its first decode
+        self._objects = 0
+        self.mask_loader = mask_loader
+        self.palette = Palette()
+        self.annotations = AnnotationStore(self.palette)
+        self.tiled = None # TiledAnnotation of the current image, only the current one is kept
+        self.tiled_size = None # full size of the current image when it is annotated in tiles
+        self.open_annotation(in_size, out_size, tiled)
         self.segment_mode = SegmentMode.SINGLE_POINT
         
-    def next_annotation(self, img_path, in_size, out_size):
-        self.sam.set_image(img_path)
-
-        self.anno_idx += 1
-        if len(self.annotations) <= self.anno_idx:
-            self.annotations.append(Annotation(in_size, out_size))
-            
-    def prev_annotation(self, img_path):
-        self.sam.set_image(img_path)
-        if self.anno_idx > 0: self.anno_idx -= 1
+    def goto_annotation(self, img_path, in_size, out_size, tiled=False):
+        self.end_object()
+        self.sam.submit('set_image', img_path)
+        self.anno_key = img_path
+        self.open_annotation(in_size, out_size, tiled)
+    
+    # first visit of an image starts from its saved mask if there is one
+    def open_annotation(self, in_size, out_size, tiled=False):
+        self.tiled = None
+        self.tiled_size = out_size if tiled else None
+        if tiled: return self.open_tiled()
+        if self.anno_key in self.annotations: return
+        annotation = Annotation(in_size, out_size, self.palette)
+        mask = self.mask_loader(self.anno_key) if self.mask_loader else None
+        if mask is not None: annotation.set_mask(mask)
+        self.annotations[self.anno_key] = annotation
+    
+    def open_tiled(self):
+        saved = self.mask_loader(self.anno_key) if self.mask_loader else None
+        if saved is not None and tuple(saved.shape[:2]) != tuple(self.tiled_size):
+            print(f'Ignoring saved mask of {self.anno_key}, its size does not match the image')
+            saved = None
+        self.tiled = TiledAnnotation(self.tiled_size, self.palette, saved)
+    
+    # hands the tiled annotation over, e.g. to be saved, it is read back from the saved mask when needed again
+    def take_tiled(self):
+        tiled = self.get_annotation()
+        self.tiled = None
+        return tiled
         
         
-    def generate_mask(self, points, label):
+    # coalesce=True refines the current object: a newer request replaces a pending one
+    # and the model starts from the previous decode of the object,
+    # boxes ([[x1, y1, x2, y2], ...]) are decoded together, one object per box
+    # in tiled mode prompts are in full resolution coordinates and go to the tile of the first one
+    def generate_mask(self, points, label, coalesce=False, boxes=None, point_labels=None):
+        annotation, tile = self.get_annotation(), {}
+        if self.tiled_size is not None and (points or boxes):
+            points, point_labels, boxes, tile = self.tile_prompts(points, point_labels, boxes)
+            annotation = self.tiled.edits(*tile['tile'])
+        if boxes:
+            self.sam.submit('predict',
+                            callback=lambda masks: self.append_masks(annotation, masks, label),
+                            boxes=np.array(boxes),
+                            **tile)
+            return
         if points == []: 
             print('no points')
             return
         
-        label_arr = np.full(len(points), 1)
-        masks = self.sam.predict(point_coords=np.array(points), 
-                                point_labels=label_arr)
-       
+        label_arr = np.full(len(points), 1) if point_labels is None else np.array(point_labels)
+        if not coalesce:
+            self.sam.submit('predict',
+                            callback=lambda masks: self.append_mask(annotation, masks, label),
+                            point_coords=np.array(points), 
+                            point_labels=label_arr,
+                            **tile)
+            return
+        
+        if self.object_id is None:
+            self._objects += 1
+            self.object_id = self._objects
+            annotation.begin_object()
+        self.sam.submit('predict',
+                        key='predict',
+                        callback=lambda masks: self.update_object(annotation, masks, label),
+                        point_coords=np.array(points), 
+                        point_labels=label_arr,
+                        obj=self.object_id,
+                        **tile)
+    
+    # prompts moved into the tile of the first one, points outside of it are dropped and boxes clipped
+    def tile_prompts(self, points, point_labels, boxes):
+        anchor = points[0] if points else [(boxes[0][0] + boxes[0][2]) / 2, (boxes[0][1] + boxes[0][3]) / 2]
+        tx, ty = self.tiled.tile_at(*anchor)
+        x, y, w, h = self.tiled.tile_rect(tx, ty)
+        if point_labels is None: point_labels = [1] * len(points)
+        inside = [(px - x, py - y, l) for (px, py), l in zip(points, point_labels)
+                  if x <= px < x + w and y <= py < y + h]
+        points = [[px, py] for px, py, _ in inside]
+        point_labels = [l for _, _, l in inside]
+        if boxes:
+            boxes = [[max(x1 - x, 0), max(y1 - y, 0), min(x2 - x, w - 1), min(y2 - y, h - 1)] for x1, y1, x2, y2 in boxes]
+            boxes = [b for b in boxes if b[0] < b[2] and b[1] < b[3]]
+        return points, point_labels, boxes, {'tile': (tx, ty), 'img_path': self.anno_key}
+    
+    # the next refinement starts a new object
+    def end_object(self):
+        self.object_id = None
+        if self.tiled is not None: self.tiled.end_object()
+        elif self.anno_key in self.annotations: self.annotations[self.anno_key].end_object()
+    
+    def append_mask(self, annotation, masks, label):
         # process mask output
-        if masks == []: 
+        if len(masks) == 0: 
             print('no masks')
             return
         mask = masks[0] #(h, w, 1)
-        self.annotations[self.anno_idx].append(mask, label)
+        annotation.append(mask, label)
+        self.mask_updated.emit()
+    
+    def update_object(self, annotation, masks, label):
+        if len(masks) == 0: 
+            print('no masks')
+            return
+        annotation.update_object(masks[0], label)
+        self.mask_updated.emit()
+    
+    def append_masks(self, annotation, masks, label):
+        if len(masks) == 0: 
+            print('no masks')
+            return
+        for mask in masks:
+            annotation.append(mask, label)
+        self.mask_updated.emit()
+    
+    @pyqtSlot(object)
+    def job_done(self, job):
+        if job.cancelled: return
+        if job.error is not None:
+            print(f'{job.kind} failed: {job.error}')
+            # a failed prefetch only costs the encode later on
+            if job.kind not in JobQueue.background: self.failed.emit(f'{job.kind} failed: {job.error}')
+        elif job.callback:
+            job.callback(job.result)
 
     
     def get_mask(self):
-        return self.annotations[self.anno_idx].get_mask()
+        return self.annotations[self.anno_key].get_mask()
     
     def get_mask_image(self):
-        return self.annotations[self.anno_idx].get_mask_image()
+        return self.annotations[self.anno_key].get_mask_image()
+    
+    # current annotation, views render its display buffer directly
+    def get_annotation(self):
+        if self.tiled_size is None: return self.annotations[self.anno_key]
+        if self.tiled is None: self.open_tiled()
+        return self.tiled
+    
+    # recolors every annotation without touching its label map
+    def set_label_color(self, value, color):
+        self.palette.set_color(value, color)
     
     def clear_mask(self):
-        self.annotations[self.anno_idx].clear_mask()
+        self.sam.jobs.cancel('predict')
+        self.object_id = None
+        self.get_annotation().clear_mask()
 
     def update_sam(self, sam):
+        if self.sam is not None: self.sam.job_done.disconnect(self.job_done)
         self.sam = sam
+        self.sam.job_done.connect(self.job_done)
 
         
         
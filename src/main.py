@@ -1,32 +1,50 @@
+import startup
+import argparse
 import sys
 import os
 from pathlib import Path
 
 from GUI import GUI
-from config import CONFIG_PATH
+from config import CONFIG_PATH, MODEL_DIR
+from model_registry import registry
 from utils import write_config_file, read_config_file
 
 from PyQt5.QtWidgets import *
-from PyQt5.QtCore import QFile, QTextStream, Qt, QSize
+from PyQt5.QtCore import QFile, QTextStream, Qt, QSize, QTimer
+startup.mark('GUI modules imported')
 
 
 class MainWindow(QMainWindow):
     def __init__(self, window_size, in_dir, out_dir):
         super().__init__()
 
-        self.gui = GUI(in_dir, out_dir)
+        self.gui = GUI(in_dir, out_dir, resume_progress=True)
         self.setCentralWidget(self.gui)
         
         self.setGeometry(0, 0, *window_size)
         
+    def closeEvent(self, event):
+        self.gui.shutdown()
+        super().closeEvent(event)
+        
         
 def main():
+    parser = argparse.ArgumentParser(description='Segmentation labeler')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='print startup milestone times once the model is ready')
+    args, qt_args = parser.parse_known_args()
+    startup.enabled = args.startup_report
+    
     os.chdir(Path(__file__).parent)
+    if not len(registry):
+        print('Failed to find SAM or FastSAM checkpoints! ' \
+              f'Please download them and move to {MODEL_DIR}')
+        sys.exit(1)
     
     # enable high dpi scaling
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
     QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
-    app = QApplication(sys.argv)
+    app = QApplication(sys.argv[:1] + qt_args)
     screen = app.primaryScreen()
     rect = screen.availableGeometry()
     
@@ -53,6 +71,10 @@ def main():
     window = MainWindow((rect.width(), rect.height()), in_dir=in_dir, out_dir=out_dir)
     window.setWindowTitle('Segmentation Labeler')
     window.showMaximized()
+    startup.mark('window shown')
+    QTimer.singleShot(0, lambda: startup.mark('first frame painted'))
+    # the model loads only after the window is up, it would compete with it for the GIL
+    QTimer.singleShot(0, window.gui.start_model)
     
     sys.exit(app.exec_())
     
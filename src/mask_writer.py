@@ -0,0 +1,242 @@
+import json
+import os
+import queue
+import threading
+from pathlib import Path
+import numpy as np
+import cv2
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from config import MASK_QUEUE_SIZE
+from tiled_image import TiffRegions
+
+
+class MaskWriter:
+    name = ''
+    suffix = ''
+
+    # masks mirror the sub folders of in_dir and keep the image suffix in their
+    # name, so a/img1.png, b/img1.png and a/img1.jpg never share a mask
+    def mask_path(self, out_dir, img_path, in_dir=None):
+        img_path = Path(img_path)
+        try:
+            folder = img_path.parent.relative_to(in_dir) if in_dir is not None else Path()
+        except ValueError:
+            folder = Path()
+        return Path(out_dir) / folder / f'{img_path.stem}_{img_path.suffix.lstrip(".")}_mask{self.suffix}'
+
+    def write(self, path, mask):
+        with open(path, 'wb') as f:
+            f.write(self.encode(mask))
+
+    # write to a temporary file next to path and rename it over path
+    def write_atomic(self, path, mask):
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.write(tmp_path, mask)
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    def encode(self, mask):
+        raise NotImplementedError
+
+    def read(self, path):
+        raise NotImplementedError
+
+
+# 8-bit png label map, 16-bit once a label value exceeds 255
+class PngMaskWriter(MaskWriter):
+    name = 'png'
+    suffix = '.png'
+
+    def encode(self, mask):
+        dtype = np.uint8 if mask.max(initial=0) <= 255 else np.uint16
+        ok, buf = cv2.imencode('.png', mask.astype(dtype, copy=False))
+        if not ok: raise ValueError('PNG encoding failed')
+        return buf.tobytes()
+
+    def read(self, path):
+        return cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+
+
+class NpzMaskWriter(MaskWriter):
+    name = 'npz'
+    suffix = '.npz'
+
+    def write(self, path, mask):
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, mask=mask)
+
+    def read(self, path):
+        with np.load(path) as data:
+            return data['mask']
+
+
+# uncompressed array, the original output format
+class NpyMaskWriter(MaskWriter):
+    name = 'npy'
+    suffix = '.npy'
+
+    def write(self, path, mask):
+        with open(path, 'wb') as f:
+            np.save(f, mask)
+
+    def read(self, path):
+        return np.load(path)
+
+
+# one COCO compressed RLE per label value
+class CocoRleMaskWriter(MaskWriter):
+    name = 'rle'
+    suffix = '.json'
+
+    def encode(self, mask):
+        h, w = mask.shape
+        annotations = [{'category_id': int(value),
+                        'segmentation': {'size': [h, w], 'counts': rle_encode(mask == value)}}
+                       for value in np.unique(mask) if value != 0]
+        return json.dumps({'height': h, 'width': w, 'annotations': annotations}).encode()
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        dtype = np.uint8
+        if any(a['category_id'] > 255 for a in data['annotations']): dtype = np.uint16
+        mask = np.zeros((data['height'], data['width']), dtype=dtype)
+        for a in data['annotations']:
+            mask[rle_decode(a['segmentation']['counts'], (data['height'], data['width']))] = a['category_id']
+        return mask
+
+
+# full resolution label map of an image annotated in tiles, written tile by tile as a tiled BigTIFF
+class TiledMaskWriter(MaskWriter):
+    name = 'tiff'
+    suffix = '.tif'
+
+    # tiled is a labeler.TiledAnnotation, tiles without labels are written as zeros
+    def write(self, path, tiled):
+        import tifffile
+
+        size = tiled.tile_size
+        cols, rows = tiled.grid()
+        def tiles():
+            for ty in range(rows):
+                for tx in range(cols):
+                    tile = np.zeros((size, size), dtype=tiled.dtype)
+                    label_map = tiled.label_map(tx, ty)
+                    if label_map is not None: tile[:label_map.shape[0], :label_map.shape[1]] = label_map
+                    yield tile
+
+        tifffile.imwrite(path, tiles(), shape=(tiled.height, tiled.width), dtype=tiled.dtype,
+                         tile=(size, size), compression='zlib', photometric='minisblack', bigtiff=True)
+
+    # read lazily, a region at a time
+    def read(self, path):
+        return TiffRegions.open(path)
+
+
+MASK_WRITERS = {writer.name: writer for writer in (PngMaskWriter, NpzMaskWriter, NpyMaskWriter, CocoRleMaskWriter)}
+
+
+def get_mask_writer(name):
+    try:
+        return MASK_WRITERS[name]()
+    except KeyError:
+        raise ValueError(f'Unknown mask format {name}, expected one of {list(MASK_WRITERS)}')
+
+
+# reads a mask saved in any of the supported formats, tiled masks are read lazily
+def read_mask(path):
+    for writer in (*MASK_WRITERS.values(), TiledMaskWriter):
+        if path.suffix == writer.suffix:
+            return writer().read(path)
+    raise ValueError(f'Unknown mask format {path.suffix}')
+
+
+# same string format as pycocotools, runs over the column-major flattened mask
+def rle_encode(binary_mask):
+    flat = binary_mask.ravel(order='F').astype(bool)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]: counts = np.concatenate(([0], counts))
+
+    chars = []
+    for i, x in enumerate(counts.tolist()):
+        if i > 2: x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more: c |= 0x20
+            chars.append(chr(c + 48))
+    return ''.join(chars)
+
+
+def rle_decode(counts, size):
+    runs = []
+    p = 0
+    while p < len(counts):
+        x = k = 0
+        more = True
+        while more:
+            c = ord(counts[p]) - 48
+            x |= (c & 0x1f) << 5 * k
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and c & 0x10: x |= -1 << 5 * k
+        if len(runs) > 2: x += runs[-2]
+        runs.append(x)
+
+    h, w = size
+    values = np.zeros(len(runs), dtype=bool)
+    values[1::2] = True
+    flat = np.repeat(values, runs)
+    return flat.reshape((w, h)).T
+
+
+class MaskSaver(QObject):
+    """Writes masks on a background thread so navigation does not wait on disk.
+
+    The queue is bounded, so `save` only blocks when storage falls more than
+    MASK_QUEUE_SIZE masks behind.
+    """
+    saved = pyqtSignal(str)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, max_pending=MASK_QUEUE_SIZE):
+        super().__init__()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='mask-saver', daemon=True)
+        self._thread.start()
+
+    # on_saved(path, mask) runs on the saver thread after a successful write
+    def save(self, writer, path, mask, on_saved=None):
+        if not self._thread.is_alive(): raise RuntimeError('Mask saver is stopped')
+        self._queue.put((writer, path, mask, on_saved))
+
+    def flush(self):
+        self._queue.join()
+
+    def stop(self):
+        if not self._thread.is_alive(): return
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None: return
+                writer, path, mask, on_saved = item
+                writer.write_atomic(path, mask)
+                if on_saved: on_saved(path, mask)
+                self.saved.emit(str(path))
+            except Exception as e:
+                self.failed.emit(str(path), str(e))
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from PyQt5.QtCore import QThread
+
+from config import MODEL_POOL_RAM
+from model_registry import registry
+
+
+class ModelPool:
+    """Model workers kept loaded, each on its own thread, within a memory budget.
+
+    Switching to a resident model reuses its worker. When the loaded models
+    exceed `max_bytes` the least recently used ones are released: their
+    worker drops the model after any job it is running and then stops its
+    thread, threads are never terminated.
+    """
+    # on_job_done(job) sees every job of every worker, e.g. to report errors
+    # of jobs nobody else is listening for
+    def __init__(self, max_bytes=MODEL_POOL_RAM, on_job_done=None):
+        self.max_bytes = max_bytes
+        self.on_job_done = on_job_done
+        self._workers = OrderedDict() # spec name -> (worker, thread)
+        self._released = [] # threads still finishing their last jobs
+
+    # returns (worker, created), a created worker starts loading on img_path,
+    # on_ready(ok) is connected before it starts, so a quick failure is not missed
+    def get(self, spec, img_path, worker_cls, on_ready=None):
+        if spec.name in self._workers:
+            self._workers.move_to_end(spec.name)
+            return self._workers[spec.name][0], False
+        
+        worker = worker_cls(spec)
+        if self.on_job_done: worker.job_done.connect(self.on_job_done)
+        if on_ready: worker.ready.connect(on_ready)
+        thread = QThread()
+        worker.moveToThread(thread)
+        thread.start(priority=QThread.TimeCriticalPriority)
+        self._workers[spec.name] = (worker, thread)
+        worker.submit('config_model', img_path)
+        self.trim()
+        return worker, True
+
+    def __contains__(self, name):
+        return name in self._workers
+
+    def __iter__(self):
+        return (worker for worker, _ in self._workers.values())
+
+    # memory of each worker, estimated from its profile until it is loaded
+    def memory(self, worker):
+        if worker.memory_bytes: return worker.memory_bytes
+        profile = registry.profile(worker.spec.name, worker.device or 'cpu')
+        return profile.get('memory_mb', 0) * 1024**2
+
+    # the most recently used model is always kept
+    def trim(self):
+        total = sum(self.memory(worker) for worker in self)
+        while total > self.max_bytes and len(self._workers) > 1:
+            name = next(iter(self._workers))
+            worker = self._workers[name][0]
+            total -= self.memory(worker)
+            self.release(name)
+
+    def release(self, name):
+        worker, thread = self._workers.pop(name)
+        print(f'Releasing model {name}')
+        worker.submit('release')
+        self._released.append((worker, thread))
+        self._released = [(w, t) for w, t in self._released if not t.isFinished()]
+
+    def stop(self, timeout=5000):
+        for name in list(self._workers):
+            self.release(name)
+        for worker, thread in self._released:
+            if not thread.wait(timeout): print(f'Model {worker.spec.name} did not stop in time')
+        self._released.clear()
@@ -0,0 +1,149 @@
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+from config import MODEL_DIR, MODEL_PROFILES_PATH, MODEL_TYPE
+
+CHECKPOINT_SUFFIXES = ('.pt', '.pth')
+SAM_TYPES = ('vit_h', 'vit_l', 'vit_b') # best quality first
+_sam_type = re.compile(r'vit_[a-z]+')
+
+
+class ModelSpec:
+    def __init__(self, name, family, model_type, check_point):
+        self.name = name # unique, shown in the model selector
+        self.family = family # 'SAM' or 'FastSAM'
+        self.model_type = model_type # sam_model_registry key, or 'FastSAM'
+        self.check_point = Path(check_point)
+
+    def __repr__(self):
+        return f'ModelSpec({self.name}, {self.check_point.name})'
+
+
+# SAM checkpoints are recognized by the backbone in their file name, e.g. sam_vit_b_01ec64.pth
+def spec_from_path(path):
+    name = path.stem.lower()
+    if 'fastsam' in name:
+        return ModelSpec(path.stem, 'FastSAM', 'FastSAM', path)
+    match = _sam_type.search(name)
+    if match:
+        return ModelSpec(f'SAM {match.group()}', 'SAM', match.group(), path)
+    return None
+
+
+class ModelRegistry:
+    """Checkpoints found in the model folder, with latency and memory profiles.
+
+    Profiles are measured while the models are used and kept per device in
+    a JSON file, so the model selector can show what each backbone costs on
+    this machine. Safe to record from any thread.
+    """
+    def __init__(self, model_dir=MODEL_DIR, profile_path=MODEL_PROFILES_PATH):
+        self.model_dir = Path(model_dir)
+        self.profile_path = Path(profile_path)
+        self._specs = None
+        self._profiles = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def discover(self):
+        specs = {}
+        paths = sorted(p for p in self.model_dir.iterdir() if p.suffix in CHECKPOINT_SUFFIXES) \
+            if self.model_dir.exists() else []
+        for path in paths:
+            spec = spec_from_path(path)
+            if spec is None: continue
+            if spec.name in specs: spec.name = f'{spec.name} ({path.stem})'
+            specs[spec.name] = spec
+        order = {t: i for i, t in enumerate(SAM_TYPES)}
+        self._specs = sorted(specs.values(),
+                             key=lambda s: (s.family != 'SAM', order.get(s.model_type, len(order)), s.name))
+        return self._specs
+
+    @property
+    def specs(self):
+        if self._specs is None: self.discover()
+        return self._specs
+
+    def get(self, name):
+        for spec in self.specs:
+            if spec.name == name: return spec
+        return None
+
+    # name saved by an older version ('SAM' or 'FastSAM') or a model name
+    def find(self, name):
+        spec = self.get(name)
+        if spec is not None: return spec
+        family = [s for s in self.specs if s.family == name]
+        for spec in family:
+            if spec.model_type == MODEL_TYPE: return spec
+        return family[0] if family else (self.specs[0] if self.specs else None)
+
+    def __len__(self):
+        return len(self.specs)
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    # running mean of each measurement, e.g. record(name, 'cpu', encode_ms=850)
+    def record(self, name, device, **measurements):
+        with self._lock:
+            profile = self._load_profiles().setdefault(self._profile_key(name, device), {})
+            for metric, value in measurements.items():
+                count = profile.get(f'{metric}_n', 0)
+                mean = profile.get(metric, 0.0)
+                profile[metric] = mean + (value - mean) / (count + 1)
+                profile[f'{metric}_n'] = count + 1
+            self._dirty = True
+
+    def profile(self, name, device):
+        with self._lock:
+            return dict(self._load_profiles().get(self._profile_key(name, device), {}))
+
+    # text for the model selector
+    def describe(self, name, device):
+        profile = self.profile(name, device)
+        parts = []
+        if 'encode_ms' in profile: parts.append(f'encode {profile["encode_ms"] / 1000:.2f} s')
+        if 'decode_ms' in profile: parts.append(f'click {profile["decode_ms"]:.0f} ms')
+        if 'memory_mb' in profile: parts.append(f'{profile["memory_mb"] / 1024:.1f} GB')
+        return f'{name} ({", ".join(parts)})' if parts else name
+
+    def save(self):
+        with self._lock:
+            if not self._dirty: return
+            data = json.dumps(self._profiles, indent=4)
+            self._dirty = False
+        tmp_path = self.profile_path.with_name(f'.{self.profile_path.name}.tmp')
+        try:
+            self.profile_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, self.profile_path)
+        except OSError as e:
+            print(f'Failed to save model profiles: {e}')
+
+    # profiles are per checkpoint file, a replaced checkpoint starts over
+    def _profile_key(self, name, device):
+        spec = self.get(name)
+        size = spec.check_point.stat().st_size if spec and spec.check_point.exists() else 0
+        return f'{name}|{size}|{device}'
+
+    def _load_profiles(self):
+        if self._profiles is None:
+            try:
+                with open(self.profile_path, 'r') as f:
+                    self._profiles = json.load(f)
+            except (OSError, ValueError):
+                self._profiles = {}
+        return self._profiles
+
+
+# parameter and buffer memory of a torch module
+def model_bytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+registry = ModelRegistry()
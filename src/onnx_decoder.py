@@ -0,0 +1,98 @@
+import os
+from pathlib import Path
+import numpy as np
+
+# the exported decoder always returns all four masks: [single mask, multimask x3]
+_input_names = ['image_embeddings', 'point_coords', 'point_labels', 'mask_input', 'has_mask_input', 'orig_im_size']
+_output_names = ['masks', 'iou_predictions', 'low_res_masks']
+
+
+def onnx_path(check_point):
+    check_point = Path(check_point)
+    return check_point.with_name(f'{check_point.stem}_decoder.onnx')
+
+
+# exports the prompt encoder and mask decoder of sam, as in segment_anything/scripts/export_onnx_model.py
+def export_decoder(sam, path, opset=17):
+    import torch
+    from segment_anything.utils.onnx import SamOnnxModel
+
+    model = SamOnnxModel(sam, return_single_mask=False)
+    device = sam.device
+    embed_dim = sam.prompt_encoder.embed_dim
+    embed_size = sam.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+    dummy_inputs = (torch.randn(1, embed_dim, *embed_size, dtype=torch.float, device=device),
+                    torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float, device=device),
+                    torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float, device=device),
+                    torch.randn(1, 1, *mask_input_size, dtype=torch.float, device=device),
+                    torch.tensor([1], dtype=torch.float, device=device),
+                    torch.tensor([1500, 2250], dtype=torch.float, device=device))
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    try:
+        with torch.no_grad():
+            torch.onnx.export(model, dummy_inputs, str(tmp_path),
+                              export_params=True,
+                              opset_version=opset,
+                              do_constant_folding=True,
+                              input_names=_input_names,
+                              output_names=_output_names,
+                              dynamic_axes={'point_coords': {1: 'num_points'},
+                                            'point_labels': {1: 'num_points'}})
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+class OnnxDecoder:
+    """SAM prompt decoding with onnxruntime on a precomputed image embedding.
+
+    `predict` takes and returns the same arrays as SamPredictor.predict, so
+    the worker can switch between backends per call.
+    """
+    def __init__(self, path, transform, threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if threads: options.intra_op_num_threads = threads
+        self.path = Path(path)
+        self.session = ort.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        self.transform = transform
+
+    def predict(self, features, original_size, point_coords, point_labels, mask_input=None, multimask_output=True):
+        # the exported model expects a padding point when no box is given
+        coords = np.concatenate([point_coords, np.zeros((1, 2))], axis=0)[None, :, :]
+        labels = np.concatenate([point_labels, np.array([-1])], axis=0)[None, :].astype(np.float32)
+        coords = self.transform.apply_coords(coords, original_size).astype(np.float32)
+        has_mask_input = np.ones(1, dtype=np.float32)
+        if mask_input is None:
+            mask_input = np.zeros((1, 256, 256), dtype=np.float32)
+            has_mask_input[0] = 0
+        masks, scores, logits = self.session.run(None, {
+            'image_embeddings': np.asarray(features, dtype=np.float32),
+            'point_coords': coords,
+            'point_labels': labels,
+            'mask_input': np.asarray(mask_input, dtype=np.float32)[None, :, :, :],
+            'has_mask_input': has_mask_input,
+            'orig_im_size': np.array(original_size, dtype=np.float32)})
+        picked = slice(1, None) if multimask_output else slice(0, 1)
+        return masks[0, picked] > 0.0, scores[0, picked], logits[0, picked]
+
+
+# exports the decoder on first use, returns None when onnxruntime is not usable
+def load_decoder(sam, check_point, transform):
+    try:
+        import onnxruntime
+    except ImportError:
+        print('onnxruntime is not installed, using the PyTorch decoder')
+        return None
+
+    path = onnx_path(check_point)
+    try:
+        if not path.exists():
+            print(f'Exporting SAM decoder to {path}')
+            export_decoder(sam, path)
+        return OnnxDecoder(path, transform)
+    except Exception as e:
+        print(f'Failed to load ONNX decoder, using the PyTorch decoder: {e}')
+        return None
@@ -0,0 +1,46 @@
+from config import PREFETCH_DEPTH
+
+
+class Prefetcher:
+    """Encodes the next few images while the model worker is otherwise idle.
+
+    Prefetches are background jobs on the worker's own queue. They run on
+    the worker thread once no other job ran for PREFETCH_IDLE seconds, so
+    they never compete with the current image for cores, and any job that
+    arrives meanwhile stops the encoder between two of its blocks. The
+    worker's `prefetch` only fills its embedding cache and never touches the
+    predictor state. Rescheduling, and any set_image or set_tile, drops them.
+    """
+    def __init__(self, worker=None, depth=PREFETCH_DEPTH):
+        self.worker = worker
+        self.depth = depth
+        self.direction = 1
+
+    def schedule(self, img_list, img_idx, direction=1):
+        end = img_idx + direction * (self.depth + 1)
+        paths = [str(img_list[i]) for i in range(img_idx + direction, end, direction)
+                 if 0 <= i < len(img_list)]
+        # anything queued for the old position or direction is stale
+        self.direction = direction
+        self._submit([(path, None) for path in paths])
+
+    # tiles (tx, ty) of an image annotated in tiles, e.g. the ones in view
+    def schedule_tiles(self, img_path, tiles):
+        self._submit([(str(img_path), tile) for tile in tiles])
+
+    def _submit(self, items):
+        self.cancel()
+        if self.worker is None: return
+        for img_path, tile in items:
+            self.worker.submit('prefetch', img_path, tile=tile, key=('prefetch', img_path, tile))
+
+    # a prefetch that is already encoding stops at the next encoder block
+    def cancel(self):
+        if self.worker is not None: self.worker.jobs.cancel('prefetch')
+
+    def set_worker(self, worker):
+        self.cancel()
+        self.worker = worker
+
+    def stop(self):
+        self.cancel()
@@ -0,0 +1,79 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+LABELED = 'labeled'
+EMPTY = 'empty' # mask saved without any labels
+
+
+class ProgressIndex:
+    """Annotation progress of a dataset, kept in SQLite in the output folder.
+
+    Rows are keyed by image path and updated as masks are saved, so resuming
+    or filtering by status never needs to list the output folder. Safe to use
+    from the mask saver thread.
+    """
+    file_name = '.annotator_progress.sqlite'
+
+    def __init__(self, out_dir):
+        self.path = Path(out_dir) / self.file_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS images (
+                                    path TEXT PRIMARY KEY,
+                                    status TEXT NOT NULL,
+                                    mask_path TEXT,
+                                    histogram TEXT,
+                                    created REAL NOT NULL,
+                                    updated REAL NOT NULL)''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS images_status ON images (status)')
+
+    # mask is a label map, or a labeler.TiledAnnotation that counts tile by tile
+    def mark_saved(self, img_path, mask_path, mask):
+        counts = mask.label_counts() if hasattr(mask, 'label_counts') else np.bincount(mask.ravel())
+        histogram = {int(v): int(counts[v]) for v in np.flatnonzero(counts) if v != 0}
+        status = LABELED if histogram else EMPTY
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('''INSERT INTO images VALUES (?, ?, ?, ?, ?, ?)
+                                  ON CONFLICT(path) DO UPDATE SET status=excluded.status,
+                                  mask_path=excluded.mask_path, histogram=excluded.histogram,
+                                  updated=excluded.updated''',
+                               (str(img_path), status, str(mask_path), json.dumps(histogram), now, now))
+
+    def get(self, img_path):
+        with self._lock:
+            row = self._conn.execute('SELECT status, mask_path, histogram, created, updated FROM images '
+                                     'WHERE path = ?', (str(img_path),)).fetchone()
+        if row is None: return None
+        return {'status': row[0],
+                'mask_path': Path(row[1]) if row[1] else None,
+                'histogram': {int(k): v for k, v in json.loads(row[2] or '{}').items()},
+                'created': row[3],
+                'updated': row[4]}
+
+    def paths(self, status=None):
+        with self._lock:
+            if status is None:
+                rows = self._conn.execute('SELECT path FROM images').fetchall()
+            else:
+                rows = self._conn.execute('SELECT path FROM images WHERE status = ?', (status,)).fetchall()
+        return [Path(row[0]) for row in rows]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute('SELECT status, COUNT(*) FROM images GROUP BY status').fetchall())
+
+    def first_unlabeled(self, img_list):
+        labeled = {str(p) for p in self.paths(LABELED)}
+        for i, img_path in enumerate(img_list):
+            if str(img_path) not in labeled: return i
+        return max(len(img_list) - 1, 0)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
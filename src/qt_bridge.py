@@ -0,0 +1,133 @@
+"""NumPy <-> Qt image conversion, sharing memory wherever the layout allows.
+
+QImage never owns memory it is built on, so every image returned by
+`np_to_qimage` keeps its array in `image.ndarray` and arrays returned by
+`qimage_to_np` keep their QImage alive through `array.base`. Drop the
+reference (or pass copy=True) before modifying either side.
+
+Run `python qt_bridge.py` for a benchmark of the per-click display path.
+"""
+import numpy as np
+from PyQt5 import sip
+from PyQt5.QtGui import QImage, QPixmap
+
+# (dtype, channels) -> QImage format with the same memory layout
+_formats = {(np.dtype(np.uint8), 1): QImage.Format_Grayscale8,
+            (np.dtype(np.uint8), 3): QImage.Format_RGB888,
+            (np.dtype(np.uint8), 4): QImage.Format_RGBA8888,
+            (np.dtype(np.uint16), 1): QImage.Format_Grayscale16,
+            (np.dtype(np.uint16), 4): QImage.Format_RGBA64}
+_layouts = {fmt: key for key, fmt in _formats.items()}
+
+
+def _as_supported(img):
+    """Array with a layout QImage can wrap, copying only when it has to."""
+    if img.ndim == 2: img = img[:, :, None]
+    if img.ndim != 3: raise ValueError(f'Expected an (h, w) or (h, w, c) image, got shape {img.shape}')
+    channels = img.shape[2]
+    if img.dtype == bool:
+        img = img.astype(np.uint8) * 255
+    elif img.dtype.kind == 'f':
+        img = (np.clip(img, 0, 1) * 255).astype(np.uint8) # floats are in [0, 1]
+    elif img.dtype == np.uint16 and channels == 3:
+        img = np.concatenate([img, np.full(img.shape[:2] + (1,), 65535, dtype=np.uint16)], axis=2)
+    elif img.dtype not in (np.uint8, np.uint16):
+        img = np.clip(img, 0, 255).astype(np.uint8)
+    if (img.dtype, img.shape[2]) not in _formats:
+        raise ValueError(f'Unsupported image of {channels} channels')
+    # pixels must be packed within a row, rows may have any stride
+    if img.strides[2] != img.itemsize or img.strides[1] != img.itemsize * img.shape[2] or img.strides[0] < 0:
+        img = np.ascontiguousarray(img)
+    return img
+
+
+def np_to_qimage(img, copy=False):
+    """QImage of an (h, w), (h, w, 3) or (h, w, 4) array.
+
+    uint8 and uint16 arrays with packed pixels are shared, not copied.
+    Other dtypes and layouts are converted once. With copy=True the image
+    owns its pixels and does not depend on the array.
+    """
+    arr = _as_supported(np.asarray(img))
+    h, w, c = arr.shape
+    # by address, so row strided views are shared too
+    image = QImage(sip.voidptr(arr.ctypes.data), w, h, arr.strides[0], _formats[(arr.dtype, c)])
+    if copy: return image.copy()
+    image.ndarray = arr # QImage only borrows the buffer
+    return image
+
+
+def np_to_qpixmap(img):
+    """QPixmap of an array, the one copy into the pixmap is unavoidable."""
+    return QPixmap.fromImage(np_to_qimage(img))
+
+
+class _ImageBuffer:
+    # exposes the pixels of a QImage to numpy and keeps the image alive
+    def __init__(self, image, shape, dtype, readonly):
+        ptr = image.constBits() if readonly else image.bits()
+        self.image = image
+        self.__array_interface__ = {'version': 3,
+                                    'shape': shape,
+                                    'typestr': dtype.str,
+                                    'strides': (image.bytesPerLine(), dtype.itemsize * shape[2], dtype.itemsize),
+                                    'data': (int(ptr), readonly)}
+
+
+def qimage_to_np(image, copy=False, readonly=True):
+    """(h, w, c) or, for grayscale, (h, w) array of a QImage, sharing its memory unless copy=True.
+
+    Formats without a numpy layout are converted to RGB888 or RGBA8888
+    first. A writable view detaches the image from other QImages sharing
+    its data, as QImage.bits does.
+    """
+    if image.format() not in _layouts:
+        image = image.convertToFormat(QImage.Format_RGBA8888 if image.hasAlphaChannel() else QImage.Format_RGB888)
+    dtype, channels = _layouts[image.format()]
+    arr = np.asarray(_ImageBuffer(image, (image.height(), image.width(), channels), dtype, readonly))
+    if channels == 1: arr = arr[:, :, 0]
+    return arr.copy() if copy else arr
+
+
+def qt_to_np(pixmap, copy=False):
+    """Array of a QPixmap, the pixmap to image conversion is the only copy."""
+    return qimage_to_np(pixmap.toImage(), copy=copy)
+
+
+def _benchmark(height=480, width=480, repeat=200):
+    import timeit
+    from PyQt5.QtWidgets import QApplication
+    from labeler import Annotation
+
+    app = QApplication.instance() or QApplication([])
+    annotation = Annotation((height, width), (height, width))
+    mask = np.zeros((height, width), dtype=bool)
+    mask[height // 3:height // 2, width // 3:width // 2] = True
+    label = {'value': 1, 'color': '#eb3434'}
+    annotation.append(mask, label)
+    display = annotation.get_display_mask()
+
+    def old_np_to_qt(img):
+        h, w, c = img.shape
+        return QPixmap(QImage(img.data, w, h, c * img.itemsize * w, QImage.Format_RGB888))
+
+    image = np_to_qimage(display)
+    print(f'Display buffer {width}x{height}:')
+    print(f'  shared with QImage: {int(image.constBits()) == display.ctypes.data}')
+    print(f'  shared back to numpy: {np.shares_memory(qimage_to_np(image), display)}')
+    cases = {'old np_to_qt, full pixmap per click': lambda: old_np_to_qt(annotation.get_display_mask()),
+             'np_to_qpixmap, one copy': lambda: np_to_qpixmap(annotation.get_display_mask()),
+             'np_to_qimage, zero copy': lambda: np_to_qimage(annotation.get_display_mask()),
+             'append + zero copy view': lambda: (annotation.append(mask, label),
+                                                 np_to_qimage(annotation.get_display_mask()))}
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=repeat, repeat=3)) / repeat
+        print(f'  {name:40s} {seconds * 1e6:8.1f} us')
+
+    pixmap = np_to_qpixmap(display)
+    seconds = min(timeit.repeat(lambda: qt_to_np(pixmap), number=repeat, repeat=3)) / repeat
+    print(f'  {"qt_to_np":40s} {seconds * 1e6:8.1f} us')
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -1,95 +1,388 @@
 import numpy as np
 import cv2
-from PyQt5.QtCore import QThread, QObject, pyqtSignal, pyqtSlot
-from segment_anything import SamPredictor, sam_model_registry
-from fastsam import FastSAM, FastSAMPrompt
+from PyQt5.QtCore import QThread, QObject, QTimer, pyqtSignal, pyqtSlot
 from utils import smart_resize
-from config import MODEL_TYPE, SAM_CHECK_POINT, FAST_SAM_CHECK_POINT, MAX_HEIGHT, MAX_WIDTH
+from image_cache import image_cache, use_tiles
+from tiled_image import open_tiled
+from embedding_cache import EmbeddingCache, make_key
+from job_queue import Job, JobQueue
+from onnx_decoder import load_decoder
+from model_registry import registry, model_bytes
+from config import MAX_HEIGHT, MAX_WIDTH, EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_RAM, DECODER_BACKEND, TILE_SIZE, PREFETCH_IDLE
+import startup
+import gc
 import time
 
+# torch, segment_anything and ultralytics are imported on the worker thread
+# when a model is configured, so the window never waits for them
 
-class FastSAMWorker(QObject):
+
+# working copy of an image, as fed to SAM
+def load_image(img_path):
+    img = image_cache.load(img_path, (MAX_WIDTH, MAX_HEIGHT))
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+# full resolution tile (tx, ty) of an image annotated in tiles
+def load_tile(img_path, tile):
+    return cv2.cvtColor(open_tiled(img_path).tile(0, *tile), cv2.COLOR_BGR2RGB)
+
+
+def sam_cache_key(img_path, model_type, check_point):
+    return make_key(img_path, model_type, check_point, MAX_WIDTH, MAX_HEIGHT)
+
+
+# tiled images are identified by their file stats, hashing gigabytes per tile is not an option
+def sam_tile_key(img_path, tile, model_type, check_point):
+    return make_key(img_path, model_type, check_point, 'tile', TILE_SIZE, *tile,
+                    image_key=open_tiled(img_path).key)
+
+
+# SAM's image encoder run block by block, None as soon as abort() is true
+def run_image_encoder(encoder, x, abort=None):
+    if abort is None: return encoder(x)
+    x = encoder.patch_embed(x)
+    if encoder.pos_embed is not None: x = x + encoder.pos_embed
+    for block in encoder.blocks:
+        if abort(): return None
+        x = block(x)
+    return encoder.neck(x.permute(0, 3, 1, 2))
+
+
+# batched version of the preprocessing and encoding done by SamPredictor.set_image,
+# None when abort() stopped the encoder
+def encode_images(sam, transform, imgs, abort=None):
+    import torch
+    
+    inputs = []
+    for img in imgs:
+        input_image = torch.as_tensor(transform.apply_image(img), device=sam.device)
+        inputs.append(input_image.permute(2, 0, 1).contiguous()[None, :, :, :])
+    with torch.no_grad():
+        batch = torch.cat([sam.preprocess(input_image) for input_image in inputs])
+        features = run_image_encoder(sam.image_encoder, batch, abort)
+        if features is None: return None
+        features = features.cpu().numpy()
+    return [{'features': features[i:i+1],
+             'original_size': np.array(img.shape[:2]),
+             'input_size': np.array(input_image.shape[-2:])}
+            for i, (img, input_image) in enumerate(zip(imgs, inputs))]
+
+
+class ModelWorker(QObject):
     ready = pyqtSignal(bool)
+    job_done = pyqtSignal(object)
+    _wake = pyqtSignal()
     
-    def __init__(self, cuda, parent=None):
-        super(self.__class__, self).__init__(parent)
-        self.device = 'cuda' if cuda else 'cpu'
+    # spec is the model_registry.ModelSpec of the checkpoint to load,
+    # cuda=None uses CUDA when it is available
+    def __init__(self, spec, cuda=None, parent=None):
+        super().__init__(parent)
+        self.spec = spec
+        self.check_point = spec.check_point
+        self.cuda = cuda
+        self.device = None if cuda is None else ('cuda' if cuda else 'cpu')
         self.configured = False
-        self.check_point = FAST_SAM_CHECK_POINT
+        self.memory_bytes = 0 # of the loaded model, used by the model pool
+        self.image_path = None # image the predictor is set to
+        self.tile = None # (tx, ty) the predictor is set to when the image is annotated in tiles
+        self.jobs = JobQueue(idle=PREFETCH_IDLE)
+        self._wake.connect(self.run_jobs)
+    
+    # queue a call to one of the worker methods, it runs on the worker thread
+    def submit(self, kind, *args, key=None, callback=None, **kwargs):
+        job = self.jobs.put(Job(kind, *args, key=key, callback=callback, **kwargs))
+        self._wake.emit()
+        return job
+    
+    @pyqtSlot()
+    def run_jobs(self):
+        while (job := self.jobs.pop()) is not None:
+            try:
+                job.result = getattr(self, job.kind)(*job.args, **job.kwargs)
+            except Exception as e:
+                job.error = e
+            if not job.cancelled: self.job_done.emit(job)
+        # background jobs wait until the foreground has been idle for a while
+        delay = self.jobs.background_delay()
+        if delay is not None: QTimer.singleShot(int(delay * 1000) + 1, self.run_jobs)
+    
+    # sets the image the model was loaded on, a failure leaves the model ready for
+    # the next image and is returned as a failed set_image job, to report after ready
+    def set_first_image(self, img_path):
+        if not img_path: return None
+        try:
+            self.set_image(img_path)
+        except Exception as e:
+            print(f'Failed to set image {img_path}: {e}')
+            job = Job('set_image', img_path)
+            job.error = e
+            return job
+        return None
+    
+    # runs on the worker thread, this is where torch gets imported
+    def resolve_device(self):
+        import torch
+        
+        if self.cuda is None: self.cuda = torch.cuda.is_available()
+        self.device = 'cuda' if self.cuda else 'cpu'
+        startup.mark('torch imported')
+    
+    # drops the model and stops the worker thread once queued jobs are done,
+    # runs as a job so a model that is still loading finishes first
+    def release(self):
+        self.configured = False
+        self.free()
+        self.memory_bytes = 0
+        self.image_path = None
+        self.tile = None
+        gc.collect()
+        if self.cuda:
+            import torch
+            torch.cuda.empty_cache()
+        QThread.currentThread().quit()
+    
+    def free(self):
+        raise NotImplementedError
+    
+    # latency and memory measurements for the model selector
+    def record(self, **measurements):
+        registry.record(self.spec.name, self.device, **measurements)
+    
+    def __str__(self):
+        return self.spec.name
+
+
+class FastSAMWorker(ModelWorker):
+    def __init__(self, spec, cuda=None, parent=None):
+        super(self.__class__, self).__init__(spec, cuda, parent)
+        self.predictor = None
     
     @pyqtSlot(str)
     def config_model(self, img_path):
         start = time.time()
         try:
+            self.resolve_device()
+            from fastsam import FastSAM
+            load_start = time.time()
             self.model = FastSAM(self.check_point, task='segment')
         except:
             self.ready.emit(self.configured)
             return
+        self.memory_bytes = model_bytes(self.model.model)
+        self.record(load_ms=(time.time() - load_start) * 1000, memory_mb=self.memory_bytes / 1024**2)
+        startup.mark('model loaded')
 
         self.configured = True
-        self.set_image(img_path)
+        # the first image also sets up and warms the predictor, later ones reuse it
+        failed = self.set_first_image(img_path)
+        if self.predictor is not None:
+            print('FastSAM ' + ', '.join(f'{stage} {ms:.0f} ms' for stage, ms in self.model.timings.items()))
         print(f'Config Time: {time.time() - start}')
         self.ready.emit(self.configured)
+        if failed: self.job_done.emit(failed)
     
     def set_image(self, img_path):
         if not self.configured: return
-        results = self.model(img_path, 
+        self.image_path = img_path
+        self.tile = None
+        self.predictor = None
+        # tiled images are segmented a tile at a time, once a prompt needs it
+        if use_tiles(img_path): return
+        # run on the working copy so masks and prompts share its coordinates
+        self.segment(image_cache.load(img_path, (MAX_WIDTH, MAX_HEIGHT)))
+    
+    def set_tile(self, img_path, tile):
+        if not self.configured or (self.image_path, self.tile) == (img_path, tile): return
+        self.predictor = None
+        self.segment(open_tiled(img_path).tile(0, *tile))
+        self.image_path = img_path
+        self.tile = tile
+    
+    # errors are raised, so a failed image is reported instead of leaving the previous masks in place
+    def segment(self, img):
+        from fastsam import FastSAMPrompt
+        start = time.time()
+        results = self.model(img, 
                             device=self.device, 
                             retina_masks=True,
                             verbose=False, 
                             imgsz=1024, 
                             conf=0.25,
                             iou=0.9)
-        self.predictor = FastSAMPrompt(img_path, results, device=self.device)
+        self.predictor = FastSAMPrompt(img, results, device=self.device)
+        self.predictor.build_index()
+        timings = self.model.timings
+        self.record(encode_ms=(time.time() - start) * 1000,
+                    setup_ms=timings['setup'],
+                    inference_ms=timings['inference'],
+                    postprocess_ms=timings['postprocess'])
     
-    def predict(self, point_coords=None, point_labels=None):
+    def free(self):
+        self.model = None
+        self.predictor = None
+    
+    # FastSAM has no reusable image embedding to cache
+    def prefetch(self, img_path, tile=None):
+        pass
+    
+    # tile=(tx, ty) of img_path takes prompts in the coordinates of that full resolution tile
+    def predict(self, point_coords=None, point_labels=None, boxes=None, obj=None, tile=None, img_path=None):
         if not self.configured: return []
-        masks = self.predictor.point_prompt(points=point_coords,
-                                           pointlabel=point_labels)
+        if tile is not None: self.set_tile(img_path, tile)
+        if self.predictor is None: raise RuntimeError(f'{self.image_path} was not segmented')
+        if boxes is not None:
+            masks = self.predictor.box_prompt(bboxes=boxes.tolist())
+        else:
+            start = time.time()
+            masks = self.predictor.point_prompt(points=point_coords,
+                                               pointlabel=point_labels)
+            self.record(decode_ms=(time.time() - start) * 1000)
+        if self.tile is not None: return list(masks)
         return [smart_resize(mask, (MAX_WIDTH, MAX_HEIGHT)) for mask in masks]
-    
-    def __str__(self):
-        return 'FastSAM'
 
 
-class SAMWorker(QObject):
-    ready = pyqtSignal(bool)
-    
-    def __init__(self, cuda, parent=None):
-        super(self.__class__, self).__init__(parent)
-        self.cuda = cuda
-        self.configured = False
-        self.check_point = SAM_CHECK_POINT
+class SAMWorker(ModelWorker):
+    def __init__(self, spec, cuda=None, parent=None):
+        super(self.__class__, self).__init__(spec, cuda, parent)
+        self.cache = EmbeddingCache(EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_RAM)
+        self.object_logits = {} # object id -> low res logits of its last decode
+        self.decoder = None # onnxruntime decoder, None uses the PyTorch one
+        self.embedding = None
     
     @pyqtSlot(str)
     def config_model(self, img_path):
         start = time.time()
         try:
-            self.sam = sam_model_registry[MODEL_TYPE](self.check_point)
+            self.resolve_device()
+            from segment_anything import SamPredictor, sam_model_registry
+            load_start = time.time()
+            self.sam = sam_model_registry[self.spec.model_type](self.check_point)
         except:
             self.ready.emit(self.configured)
             return
         if self.cuda: self.sam.to(device='cuda')
+        self.memory_bytes = model_bytes(self.sam)
+        self.record(load_ms=(time.time() - load_start) * 1000, memory_mb=self.memory_bytes / 1024**2)
+        startup.mark('model loaded')
         self.predictor = SamPredictor(self.sam)
+        if DECODER_BACKEND == 'onnx' or (DECODER_BACKEND == 'auto' and not self.cuda):
+            self.decoder = load_decoder(self.sam, self.check_point, self.predictor.transform)
         self.configured = True
-        self.set_image(img_path)
+        failed = self.set_first_image(img_path)
         print(f'Config Time: {time.time() - start}')
         self.ready.emit(self.configured)
+        if failed: self.job_done.emit(failed)
     
     def set_image(self, img_path):
-        img = cv2.imread(img_path)
-        img = smart_resize(img, (MAX_WIDTH, MAX_HEIGHT))
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        if self.configured: self.predictor.set_image(img)
+        if not self.configured: return
+        self.object_logits.clear()
+        self.tile = None
+        # tiles of a tiled image are encoded once a prompt or the view needs them
+        if use_tiles(img_path):
+            self.embedding = None
+            self.predictor.reset_image()
+        else:
+            self.restore_embedding(self.get_embedding(img_path))
+        self.image_path = img_path
+    
+    def set_tile(self, img_path, tile):
+        if not self.configured or (self.image_path, self.tile) == (img_path, tile): return
+        self.object_logits.clear()
+        self.restore_embedding(self.get_embedding(img_path, tile=tile))
+        self.image_path = img_path
+        self.tile = tile
     
-    def predict(self, *args, **kwargs):
+    # encode an upcoming image, or a tile of the current one, into the cache without touching the predictor,
+    # a job arriving meanwhile stops the encoder within a block, the prefetch then waits its turn again
+    def prefetch(self, img_path, tile=None):
+        if not self.configured or (tile is None and use_tiles(img_path)): return
+        job = self.jobs.current
+        abort = lambda: job.cancelled or self.jobs.has_foreground()
+        if self.get_embedding(img_path, tile=tile, abort=abort) is None and not job.cancelled:
+            self.jobs.put(Job('prefetch', img_path, tile=tile, key=job.key)) # run_jobs is still popping
+    
+    # None when abort() stopped the encoder
+    def get_embedding(self, img_path, tile=None, abort=None):
+        key = self.cache_key(img_path, tile)
+        entry = self.cache.get(key)
+        if entry is not None: return entry
+        entry = self.encode(img_path, tile, abort)
+        if entry is not None: self.cache.put(key, entry)
+        return entry
+    
+    def encode(self, img_path, tile=None, abort=None):
+        img = load_image(img_path) if tile is None else load_tile(img_path, tile)
+        start = time.time()
+        entries = encode_images(self.sam, self.predictor.transform, [img], abort)
+        if entries is None: return None
+        self.record(encode_ms=(time.time() - start) * 1000)
+        return entries[0]
+    
+    def cache_key(self, img_path, tile=None):
+        if tile is not None: return sam_tile_key(img_path, tile, self.spec.model_type, self.check_point)
+        return sam_cache_key(img_path, self.spec.model_type, self.check_point)
+    
+    def restore_embedding(self, entry):
+        import torch
+        
+        self.embedding = entry
+        self.predictor.reset_image()
+        self.predictor.features = torch.from_numpy(entry['features']).to(self.predictor.device)
+        self.predictor.original_size = tuple(int(v) for v in entry['original_size'])
+        self.predictor.input_size = tuple(int(v) for v in entry['input_size'])
+        self.predictor.is_image_set = True
+    
+    def free(self):
+        self.sam = None
+        self.predictor = None
+        self.decoder = None
+        self.embedding = None
+        self.object_logits.clear()
+        self.cache.clear_ram()
+    
+    def cache_stats(self):
+        return self.cache.stats()
+    
+    # obj identifies an object refined over several calls, each call starts
+    # from the low res logits of the previous one, tile=(tx, ty) of img_path
+    # takes prompts in the coordinates of that full resolution tile
+    def predict(self, point_coords=None, point_labels=None, boxes=None, obj=None, tile=None, img_path=None):
         if not self.configured: return []
-        masks, scores, logits = self.predictor.predict(*args, **kwargs)
-        return masks
+        if tile is not None: self.set_tile(img_path, tile)
+        if boxes is not None: return self.predict_boxes(boxes)
+        mask_input = self.object_logits.get(obj) if obj is not None else None
+        # a lone first click is ambiguous, let the decoder propose several masks
+        multimask = mask_input is None and len(point_coords) == 1
+        start = time.time()
+        masks, scores, logits = self.decode(point_coords, point_labels, mask_input, multimask)
+        self.record(decode_ms=(time.time() - start) * 1000)
+        best = int(np.argmax(scores))
+        if obj is not None: self.object_logits[obj] = logits[best][None, :, :] #(1, 256, 256)
+        return masks[best:best+1]
     
-    def __str__(self):
-        return 'SAM'
-
-
-            
-    
\ No newline at end of file
+    def decode(self, point_coords, point_labels, mask_input, multimask):
+        if self.decoder is not None:
+            try:
+                return self.decoder.predict(self.embedding['features'], self.predictor.original_size,
+                                            point_coords, point_labels, mask_input, multimask)
+            except Exception as e:
+                print(f'ONNX decoder failed, falling back to PyTorch: {e}')
+                self.decoder = None
+        return self.predictor.predict(point_coords=point_coords,
+                                      point_labels=point_labels,
+                                      mask_input=mask_input,
+                                      multimask_output=multimask)
+    
+    # one mask per box, all boxes through the decoder in a single batch
+    def predict_boxes(self, boxes):
+        import torch
+        
+        boxes = torch.as_tensor(boxes, dtype=torch.float, device=self.predictor.device)
+        boxes = self.predictor.transform.apply_boxes_torch(boxes, self.predictor.original_size)
+        with torch.no_grad():
+            masks, scores, logits = self.predictor.predict_torch(point_coords=None,
+                                                                 point_labels=None,
+                                                                 boxes=boxes,
+                                                                 multimask_output=False)
+        return masks[:, 0].cpu().numpy() #(b, h, w)
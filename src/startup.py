@@ -0,0 +1,30 @@
+"""Startup milestones, printed with `python main.py --startup-report`.
+
+Import this module before anything else so times are measured from the
+start of the process. For a per module breakdown of import time run
+`python -X importtime main.py`.
+"""
+import sys
+import threading
+import time
+
+_start = time.perf_counter()
+_marks = []
+_lock = threading.Lock()
+enabled = False
+
+
+# seconds since startup, and whether the ML stack was imported by then
+def mark(name):
+    with _lock:
+        if any(n == name for n, _, _ in _marks): return
+        _marks.append((name, time.perf_counter() - _start, 'torch' in sys.modules))
+
+
+def report():
+    if not enabled: return
+    with _lock:
+        marks = list(_marks)
+    print('Startup report:')
+    for name, elapsed, torch_loaded in marks:
+        print(f'  {elapsed * 1000:8.1f} ms  {name}{"" if torch_loaded else "  (torch not imported)"}')
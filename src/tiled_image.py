@@ -0,0 +1,292 @@
+"""Region reads and a lazily built pyramid for TIFFs too large to load whole.
+
+Level 0 is full resolution and every further level halves both sides, down
+to the first level that fits in a single tile. Tiles of levels the file
+stores (pyramidal TIFFs) are decoded from the segments they cover, the
+others are built from four tiles of the level below on first use. The
+overview reads the smallest stored level that is large enough, whether or
+not it matches one of ours. Decoded tiles live in one byte bounded LRU, so
+memory follows what is on screen rather than the size of the image.
+
+Tiles are BGR uint8, as cv2.imread would return them. Needs tifffile.
+"""
+import math
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import cv2
+
+from config import TILE_SIZE, TILE_CACHE_RAM
+
+_tiff_suffixes = ('.tif', '.tiff')
+
+
+def _tifffile():
+    try:
+        import tifffile
+        return tifffile
+    except ImportError:
+        return None
+
+
+def is_tiff(path):
+    return Path(path).suffix.lower() in _tiff_suffixes
+
+
+# (height, width) of the first image in a TIFF, None when tifffile can not tell
+def tiff_size(path):
+    tifffile = _tifffile()
+    if tifffile is None: return None
+    try:
+        with tifffile.TiffFile(path) as tif:
+            page = tif.series[0].keyframe
+            return page.imagelength, page.imagewidth
+    except Exception:
+        return None
+
+
+class TiffRegions:
+    """Raw pixels of one TIFF page, read a region at a time.
+
+    Only the tiles or strips a region touches are read and decoded. Pages
+    that can not be read by segment are decoded once into a temporary
+    memory mapped file. Safe to read from several threads.
+    """
+    def __init__(self, tif, page, lock):
+        self.tif = tif
+        self.page = page
+        self.lock = lock
+        self.height, self.width = page.imagelength, page.imagewidth
+        self.dtype = page.dtype
+        self._array = None
+        if page.is_tiled:
+            self.segment_size = (page.tilelength, page.tilewidth)
+        else:
+            self.segment_size = (page.rowsperstrip or self.height, self.width)
+        # a single huge strip is cheaper to decode once than once per region
+        self.by_segment = page.planarconfig == 1 and page.imagedepth == 1 and \
+            self.segment_size[0] * self.segment_size[1] <= 4 * TILE_SIZE**2
+        # uncompressed pixels stored in one piece are mapped, not read
+        if page.is_contiguous and page.planarconfig == 1 and page.imagedepth == 1:
+            self._array = np.memmap(tif.filehandle.path, dtype=page.dtype.newbyteorder(tif.byteorder), mode='r',
+                                    offset=page.dataoffsets[0], shape=page.shape)
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @classmethod
+    def open(cls, path):
+        tifffile = _tifffile()
+        if tifffile is None: raise ImportError('tifffile is needed to read large TIFFs')
+        tif = tifffile.TiffFile(path)
+        return cls(tif, tif.series[0].keyframe, threading.Lock())
+
+    # (h, w) or (h, w, samples) array of the region
+    def region(self, x, y, w, h):
+        if self._array is None and not self.by_segment:
+            with self.lock:
+                if self._array is None:
+                    array = self.page.asarray(out='memmap')
+                    self._array = np.moveaxis(array, 0, -1) if self.page.planarconfig == 2 else array
+        if self._array is not None:
+            return np.array(self._array[y:y + h, x:x + w])
+
+        seg_h, seg_w = self.segment_size
+        across = math.ceil(self.width / seg_w)
+        out = None
+        for row in range(y // seg_h, (y + h - 1) // seg_h + 1):
+            for col in range(x // seg_w, (x + w - 1) // seg_w + 1):
+                index = row * across + col
+                with self.lock:
+                    fh = self.tif.filehandle
+                    fh.seek(self.page.dataoffsets[index])
+                    data = fh.read(self.page.databytecounts[index])
+                segment, (_, _, top, left, _), _ = self.page.decode(data, index, jpegtables=self.page.jpegtables)
+                segment = segment[0] # (h, w, samples)
+                if out is None: out = np.zeros((h, w, segment.shape[-1]), dtype=segment.dtype)
+                # overlap of the segment and the region, in image coordinates
+                y0, y1 = max(y, top), min(y + h, top + segment.shape[0], self.height)
+                x0, x1 = max(x, left), min(x + w, left + segment.shape[1], self.width)
+                out[y0 - y:y1 - y, x0 - x:x1 - x] = segment[y0 - top:y1 - top, x0 - left:x1 - left]
+        return out[:, :, 0] if out.shape[2] == 1 else out
+
+    def close(self):
+        self._array = None
+        self.tif.close()
+
+
+def _to_bgr8(region, value_range):
+    if region.dtype != np.uint8:
+        lo, hi = value_range
+        region = np.clip((region.astype(np.float32) - lo) * (255 / max(hi - lo, 1e-6)), 0, 255).astype(np.uint8)
+    if region.ndim == 2 or region.shape[2] < 3:
+        return cv2.cvtColor(np.ascontiguousarray(region if region.ndim == 2 else region[:, :, 0]), cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(np.ascontiguousarray(region[:, :, :3]), cv2.COLOR_RGB2BGR)
+
+
+class TileCache:
+    """LRU of decoded tiles by (image key, level, tx, ty), bounded in bytes."""
+    def __init__(self, max_bytes=TILE_CACHE_RAM):
+        self.max_bytes = max_bytes
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None: self._tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        tile.flags.writeable = False
+        with self._lock:
+            if key in self._tiles or tile.nbytes > self.max_bytes: return
+            self._tiles[key] = tile
+            self._bytes += tile.nbytes
+            while self._bytes > self.max_bytes:
+                _, old = self._tiles.popitem(last=False)
+                self._bytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._bytes = 0
+
+
+tile_cache = TileCache()
+
+
+class TiledImage:
+    def __init__(self, path, tile_size=TILE_SIZE, cache=tile_cache):
+        tifffile = _tifffile()
+        if tifffile is None: raise ImportError('tifffile is needed to read large TIFFs')
+        self.path = Path(path)
+        self.tile_size = tile_size
+        self.cache = cache
+        stat = self.path.stat()
+        # identifies the file contents without reading them, for tile and embedding caches
+        self.key = f'{self.path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}'
+
+        self._tif = tifffile.TiffFile(self.path)
+        lock = threading.Lock() # one file handle for every level
+        series = self._tif.series[0]
+        level0 = TiffRegions(self._tif, series.keyframe, lock)
+        self.height, self.width = level0.height, level0.width
+        h, w = self.height, self.width
+        self.shapes = [(h, w)]
+        while max(h, w) > tile_size:
+            h, w = math.ceil(h / 2), math.ceil(w / 2)
+            self.shapes.append((h, w))
+
+        # every level the file stores, and the ones that match ours within a pixel
+        self._stored = [level0] + [TiffRegions(self._tif, level.keyframe, lock) for level in series.levels[1:]]
+        self._native = {0: level0}
+        for source in self._stored[1:]:
+            for k, (h, w) in enumerate(self.shapes):
+                if abs(source.height - h) <= 1 and abs(source.width - w) <= 1:
+                    self._native[k] = source
+        self.value_range = self._value_range()
+
+    @property
+    def levels(self):
+        return len(self.shapes)
+
+    # grid size (columns, rows) of a level
+    def grid(self, level):
+        h, w = self.shapes[level]
+        return math.ceil(w / self.tile_size), math.ceil(h / self.tile_size)
+
+    # (x, y, w, h) of a tile in the coordinates of its level
+    def tile_rect(self, level, tx, ty):
+        h, w = self.shapes[level]
+        x, y = tx * self.tile_size, ty * self.tile_size
+        return x, y, min(self.tile_size, w - x), min(self.tile_size, h - y)
+
+    # the tile if it is decoded already, None otherwise
+    def cached_tile(self, level, tx, ty):
+        return self.cache.get((self.key, level, tx, ty))
+
+    def tile(self, level, tx, ty):
+        key = (self.key, level, tx, ty)
+        tile = self.cache.get(key)
+        if tile is not None: return tile
+
+        x, y, w, h = self.tile_rect(level, tx, ty)
+        source = self._native.get(level)
+        if source is not None:
+            region = source.region(x, y, min(w, source.width - x), min(h, source.height - y))
+            tile = _to_bgr8(region, self.value_range)
+            if tile.shape[:2] != (h, w): # stored level a pixel short
+                tile = np.pad(tile, ((0, h - tile.shape[0]), (0, w - tile.shape[1]), (0, 0)), mode='edge')
+        else:
+            # the four tiles below cover this one at twice the size
+            cols, rows = self.grid(level - 1)
+            below = np.zeros((2 * self.tile_size, 2 * self.tile_size, 3), dtype=np.uint8)
+            bw = bh = 0
+            for j in range(2):
+                for i in range(2):
+                    if 2 * tx + i >= cols or 2 * ty + j >= rows: continue
+                    child = self.tile(level - 1, 2 * tx + i, 2 * ty + j)
+                    below[j * self.tile_size:j * self.tile_size + child.shape[0],
+                          i * self.tile_size:i * self.tile_size + child.shape[1]] = child
+                    if j == 0: bw += child.shape[1]
+                    if i == 0: bh += child.shape[0]
+            tile = cv2.resize(below[:bh, :bw], (w, h), interpolation=cv2.INTER_AREA)
+        self.cache.put(key, tile)
+        return tile
+
+    # whole image shrunk to fit max_size (width, height), read at once from the smallest level the
+    # file stores that is still as large, else put together from the tiles of our own level
+    def overview(self, max_size):
+        from utils import smart_resize, smart_size
+        h, w = smart_size((self.height, self.width), max_size)
+        source = min((s for s in self._stored if s.height >= h and s.width >= w), key=lambda s: s.height * s.width)
+        if source.height * source.width <= 4 * self.tile_size**2:
+            return smart_resize(_to_bgr8(source.region(0, 0, source.width, source.height), self.value_range), max_size)
+        level = max(k for k, shape in enumerate(self.shapes) if shape[0] >= h and shape[1] >= w)
+        cols, rows = self.grid(level)
+        image = np.zeros(self.shapes[level] + (3,), dtype=np.uint8)
+        for ty in range(rows):
+            for tx in range(cols):
+                x, y, tw, th = self.tile_rect(level, tx, ty)
+                image[y:y + th, x:x + tw] = self.tile(level, tx, ty)
+        return smart_resize(image, max_size)
+
+    # scaling of non 8-bit images, from the coarsest stored level when it is small
+    def _value_range(self):
+        source = self._native[max(self._native)]
+        if source.dtype == np.uint8: return None
+        if source.height * source.width <= 4 * self.tile_size**2:
+            sample = source.region(0, 0, source.width, source.height)
+            lo, hi = np.percentile(sample, (0.5, 99.5))
+            if hi > lo: return float(lo), float(hi)
+        if source.dtype.kind in 'ui': return 0, np.iinfo(source.dtype).max
+        return 0, 1 # floats are in [0, 1]
+
+    def close(self):
+        self._tif.close()
+
+
+_open = OrderedDict()
+_open_lock = threading.Lock()
+
+
+# shared by the GUI and the model workers, the few most recent stay open,
+# older ones are closed once nothing uses them any more
+def open_tiled(path, keep=4):
+    path = str(path)
+    with _open_lock:
+        image = _open.get(path)
+        if image is not None:
+            _open.move_to_end(path)
+            return image
+    image = TiledImage(path)
+    with _open_lock:
+        if path in _open: return _open[path]
+        _open[path] = image
+        while len(_open) > keep:
+            _open.popitem(last=False)
+    return image
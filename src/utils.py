@@ -1,9 +1,8 @@
-import numpy as np
 import cv2
 from pathlib import Path
 from copy import deepcopy
 import json
-from PyQt5.QtGui import QPixmap, QImage
+import qt_bridge
 
 from config import CONFIG_PATH
 
@@ -14,24 +13,20 @@ color_dict = {
     "green": "#34eb34"
 }
 
+# conversions live in qt_bridge, these keep the old names working
 def np_to_qt(img):
-    h, w, c = img.shape
-    nbytes = img.itemsize
-    bytesPerLine = c * nbytes * w
-    
-    if c == 4:
-        q_img = QPixmap(QImage(img.data, w, h, bytesPerLine, QImage.Format_RGBA64))
-    else:
-        q_img = QPixmap(QImage(img.data, w, h, bytesPerLine, QImage.Format_RGB888))
-    
-    return q_img
+    return qt_bridge.np_to_qpixmap(img)
+
+def np_to_qimage(img):
+    return qt_bridge.np_to_qimage(img)
 
 def qt_to_np(pixmap):
-    img = pixmap.toImage()
-    h, w, c = img.height(), img.width(), img.depth()//8
-    s = img.bits().asstring(w * h * c)
-    np_arr = np.fromstring(s, dtype=np.uint8).reshape((h, w, c)) 
-    return np_arr
+    return qt_bridge.qt_to_np(pixmap)
+
+# '#rrggbb' -> (r, g, b)
+def hex_to_rgb(color):
+    color = color.lstrip('#')
+    return tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
 
 # sets and returns value of new attr
 def set_attr(parent, name, val):
@@ -64,16 +59,21 @@ def write_config_file(data, setting_name=None):
             return False
     return True
 
+# (height, width) smart_resize gives an image of size (height, width)
+def smart_size(size, dsize):
+    height, width = size
+    target_width, target_height = dsize
+    if height < target_height and width < target_width:
+        return height, width
+    elif height > width:
+        return target_height, round(target_height * (width / height))
+    else:
+        return round(target_width * (height / width)), target_width
+
 # resize image while maintaining aspect ratio
 def smart_resize(img, dsize):
-    height, width = img.shape[:2]
-    target_width, target_height = dsize
     resized = deepcopy(img)
-    if height < target_height and width < target_width: 
+    height, width = smart_size(img.shape[:2], dsize)
+    if (height, width) == img.shape[:2]:
         return resized
-    elif height > width:
-        new_width = round(target_height * (width / height))
-        return cv2.resize(resized, (new_width, target_height))
-    else:
-        new_height = round(target_width * (height / width))
-        return cv2.resize(resized, (target_width, new_height))
\ No newline at end of file
+    return cv2.resize(resized, (width, height))
\ No newline at end of file
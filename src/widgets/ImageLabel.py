@@ -1,36 +1,116 @@
 from PyQt5.QtWidgets import *
-from PyQt5.QtGui import QPainter, QBrush, QColor
+from PyQt5.QtGui import QPainter, QBrush, QColor, QPen
+from PyQt5.QtCore import Qt, QRect
 import sys
 sys.path.append('..')
-from utils import np_to_qt
+from utils import np_to_qt, np_to_qimage
 
 class ImageLabel(QLabel):
     def __init__(self, img):
         super().__init__()
         
+        self.overlay = None # mask display buffer drawn over the image
+        self.overlay_img = None
+        self.overlay_opacity = 0.0
         self.setPixmap(img)
         self.points = []
+        self.point_labels = [] # 1 for positive, 0 for negative points
+        self.boxes = []
+        self.drag_start = None # corner of the box being drawn
+        self.drag_rect = None
         
+    # only the invalidated part of the image and overlay layers is redrawn
     def paintEvent(self, event):
         painter = QPainter(self)
-        painter.drawPixmap(self.rect(), self.img)
+        rect = event.rect()
+        painter.drawPixmap(rect, self.img, rect)
+        if self.overlay_img is not None and self.overlay_opacity > 0:
+            # screen leaves unlabeled (black) pixels of the overlay untouched
+            painter.setCompositionMode(QPainter.CompositionMode_Screen)
+            painter.setOpacity(self.overlay_opacity)
+            painter.drawImage(rect, self.overlay_img, rect)
+            painter.setOpacity(1.0)
+            painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
         painter.setBrush(QBrush(QColor('cyan')))
         painter.setRenderHint(QPainter.Antialiasing, True)
-        for pos in self.points:
+        for pos, label in zip(self.points, self.point_labels):
+            painter.setBrush(QBrush(QColor('cyan' if label else 'red')))
             painter.drawEllipse(pos, 4, 4)
+        
+        painter.setBrush(Qt.NoBrush)
+        painter.setPen(QPen(QColor('cyan'), 2))
+        for rect in self.boxes:
+            painter.drawRect(rect)
+        if self.drag_rect is not None:
+            painter.setPen(QPen(QColor('cyan'), 1, Qt.DashLine))
+            painter.drawRect(self.drag_rect)
             
     def setPixmap(self, img):
         self.img = np_to_qt(img)
         return super().setPixmap(self.img)
     
+    # the overlay shares memory with the array, repaint with update_overlay after edits
+    def set_overlay(self, overlay):
+        self.overlay = overlay
+        self.overlay_img = np_to_qimage(overlay)
+        if self.overlay_opacity > 0: self.update()
+    
+    def update_overlay(self, rect):
+        if rect is not None and self.overlay_opacity > 0: self.update(QRect(*rect))
+    
+    def set_overlay_opacity(self, opacity):
+        self.overlay_opacity = opacity
+        self.update()
+    
+    # image pixel under a widget position, None outside of the image
+    def image_pos(self, pos):
+        if not (0 <= pos.x() < self.img.width() and 0 <= pos.y() < self.img.height()): return None
+        return pos
+    
     def clear_points(self):
         self.points.clear()
+        self.point_labels.clear()
+        self.boxes.clear()
+        self.drag_start = None
+        self.drag_rect = None
         self.update()
         
-    def update_points(self, point, draw=True):
+    def update_points(self, point, draw=True, label=1):
         self.points.append(point)
+        self.point_labels.append(label)
         if draw: self.update()
         
     def get_points(self):
         points = [[p.x(), p.y()] for p in self.points]
-        return points
\ No newline at end of file
+        return points
+    
+    def get_point_labels(self):
+        return list(self.point_labels)
+    
+    # rubber band box drawing, started by the owner on mouse press
+    def start_box(self, pos):
+        self.drag_start = self._clamp(pos)
+        self.drag_rect = QRect(self.drag_start, self.drag_start)
+        self.update()
+    
+    def mouseMoveEvent(self, event):
+        if self.drag_start is None: return super().mouseMoveEvent(event)
+        self.drag_rect = QRect(self.drag_start, self._clamp(event.pos())).normalized()
+        self.update()
+    
+    def mouseReleaseEvent(self, event):
+        if self.drag_start is None: return super().mouseReleaseEvent(event)
+        rect = QRect(self.drag_start, self._clamp(event.pos())).normalized()
+        if rect.width() > 1 and rect.height() > 1: self.boxes.append(rect)
+        self.drag_start = None
+        self.drag_rect = None
+        self.update()
+    
+    # [[x1, y1, x2, y2], ...] in image coordinates
+    def get_boxes(self):
+        return [[r.left(), r.top(), r.right(), r.bottom()] for r in self.boxes]
+    
+    def _clamp(self, pos):
+        pos.setX(min(max(pos.x(), 0), self.img.width() - 1))
+        pos.setY(min(max(pos.y(), 0), self.img.height() - 1))
+        return pos
@@ -0,0 +1,36 @@
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import QPainter
+from PyQt5.QtCore import QRect, QSize
+import numpy as np
+import sys
+sys.path.append('..')
+from utils import np_to_qimage
+
+class MaskView(QWidget):
+    """Shows an annotation's display buffer without copying it.
+
+    The QImage shares memory with the array, so after the annotation edits
+    the array only the dirty rect needs to be repainted.
+    """
+    def __init__(self, height, width):
+        super().__init__()
+        self.mask = None
+        self.set_mask(np.zeros((height, width, 3), dtype=np.uint8))
+    
+    def set_mask(self, mask):
+        self.mask = mask # keeps the buffer alive as long as the image uses it
+        self.img = np_to_qimage(mask)
+        self.setFixedSize(self.img.width(), self.img.height())
+        self.update()
+    
+    # (x, y, w, h) rect of the array that changed
+    def update_rect(self, rect):
+        if rect is not None: self.update(QRect(*rect))
+    
+    def sizeHint(self):
+        return QSize(self.img.width(), self.img.height())
+    
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        rect = event.rect()
+        painter.drawImage(rect, self.img, rect)
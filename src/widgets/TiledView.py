@@ -0,0 +1,277 @@
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import QPainter, QBrush, QColor, QPen
+from PyQt5.QtCore import Qt, QObject, QPoint, QPointF, QRectF, pyqtSignal, pyqtSlot
+import math
+import threading
+import sys
+sys.path.append('..')
+from utils import np_to_qimage
+
+
+class TileLoader(QObject):
+    """Decodes tiles into the tile cache on a background thread.
+
+    Each request replaces the tiles still waiting, so tiles that panned or
+    zoomed out of view are never decoded. `loaded` is emitted once a tile
+    can be read from the cache.
+    """
+    loaded = pyqtSignal(object) # the TiledImage
+
+    def __init__(self):
+        super().__init__()
+        self._waiting = [] # (image, level, tx, ty), first is next
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='tile-loader', daemon=True)
+        self._thread.start()
+
+    def request(self, tiles):
+        with self._cond:
+            self._waiting = list(tiles)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._waiting and not self._stopped: self._cond.wait()
+                if self._stopped: return
+                image, level, tx, ty = self._waiting.pop(0)
+            try:
+                image.tile(level, tx, ty)
+            except Exception as e:
+                print(f'Failed to read tile {level} {tx} {ty} of {image.path}: {e}')
+                continue
+            self.loaded.emit(image)
+
+
+class TiledView(QWidget):
+    """Zoomable, pannable view of a tiled image and its tiled annotation.
+
+    Only the tiles intersecting the viewport are fetched, from the pyramid
+    level closest to the zoom, so memory follows what is on screen. Tiles are
+    decoded by a TileLoader, until they arrive a decoded tile of a coarser
+    level is stretched over their place. The wheel
+    zooms, the middle button or Ctrl + left button pans. Points and boxes are
+    kept in full resolution image coordinates and have the same methods as
+    ImageLabel.
+    """
+    pressed = pyqtSignal(object) # mouse presses that do not pan
+    view_changed = pyqtSignal()
+
+    def __init__(self, width, height):
+        super().__init__()
+        self.setMinimumSize(width, height)
+        self.image = None # tiled_image.TiledImage
+        self.annotation = None # labeler.TiledAnnotation
+        self.scale = 1.0 # screen pixels per image pixel
+        self.origin = QPointF(0, 0) # image point at the top left corner
+        self.overlay_opacity = 0.5
+        self.points = []
+        self.point_labels = []
+        self.boxes = [] # QRectF in image coordinates
+        self.drag_start = None
+        self.drag_rect = None
+        self.pan_start = None # (widget pos, origin) while panning
+        self.moved = False # zoomed or panned since the image was set
+        self.loader = TileLoader()
+        self.loader.loaded.connect(self.tile_loaded)
+
+    def set_image(self, image):
+        self.image = image
+        self.moved = False
+        self.loader.request([])
+        self.clear_points()
+        self.fit()
+
+    def set_annotation(self, annotation):
+        self.annotation = annotation
+        self.update()
+
+    # whole image in view
+    def fit(self):
+        if self.image is None: return
+        self.scale = min(self.width() / self.image.width, self.height() / self.image.height)
+        self.origin = QPointF((self.image.width - self.width() / self.scale) / 2,
+                              (self.image.height - self.height() / self.scale) / 2)
+        self.update()
+        self.view_changed.emit()
+
+    def resizeEvent(self, event):
+        if not self.moved: self.fit()
+    
+    # pyramid level with at least one tile pixel per screen pixel
+    def level(self):
+        if self.image is None: return 0
+        return min(max(int(math.floor(math.log2(1 / self.scale))), 0), self.image.levels - 1)
+
+    def to_image(self, pos):
+        return QPointF(pos) / self.scale + self.origin
+
+    def to_widget(self, point):
+        return (QPointF(point) - self.origin) * self.scale
+
+    # image pixel under a widget position, None outside of the image
+    def image_pos(self, pos):
+        p = self.to_image(pos)
+        if self.image is None or not (0 <= p.x() < self.image.width and 0 <= p.y() < self.image.height): return None
+        return QPoint(int(p.x()), int(p.y()))
+
+    # (tx, ty) of the tiles of a level in view, nearest to the center first
+    def visible_tiles(self, level=0):
+        if self.image is None: return []
+        span = self.image.tile_size << level
+        top_left, bottom_right = self.to_image(QPoint(0, 0)), self.to_image(QPoint(self.width(), self.height()))
+        cols, rows = self.image.grid(level)
+        center = (top_left + bottom_right) / 2
+        tiles = [(tx, ty) for ty in range(max(int(top_left.y() // span), 0), min(int(bottom_right.y() // span) + 1, rows))
+                 for tx in range(max(int(top_left.x() // span), 0), min(int(bottom_right.x() // span) + 1, cols))]
+        return sorted(tiles, key=lambda t: ((t[0] + 0.5) * span - center.x())**2 + ((t[1] + 0.5) * span - center.y())**2)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(event.rect(), QColor(40, 40, 40))
+        if self.image is None: return
+        level = self.level()
+        step = 1 << level
+        missing = []
+        for tx, ty in self.visible_tiles(level):
+            x, y, w, h = self.image.tile_rect(level, tx, ty)
+            target = QRectF(self.to_widget(QPointF(x * step, y * step)), self.to_widget(QPointF((x + w) * step, (y + h) * step)))
+            # every tile in view is requested, partial repaints would drop the others
+            tile = self.image.cached_tile(level, tx, ty)
+            if tile is None: missing.append((self.image, level, tx, ty))
+            if not target.intersects(QRectF(event.rect())): continue
+            if tile is not None: painter.drawImage(target, np_to_qimage(tile))
+            else: self.draw_placeholder(painter, target, level, x, y, w, h)
+            display = self.annotation.display_tile(level, tx, ty) if self.annotation and self.overlay_opacity > 0 else None
+            if display is not None:
+                # screen leaves unlabeled (black) pixels of the overlay untouched
+                painter.setCompositionMode(QPainter.CompositionMode_Screen)
+                painter.setOpacity(self.overlay_opacity)
+                painter.drawImage(target, np_to_qimage(display))
+                painter.setOpacity(1.0)
+                painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        # the coarsest level is the placeholder of last resort, so it follows the tiles in view
+        top = self.image.levels - 1
+        if missing and level < top and self.image.cached_tile(top, 0, 0) is None: missing.append((self.image, top, 0, 0))
+        if missing: self.loader.request(missing)
+
+        painter.setRenderHint(QPainter.Antialiasing, True)
+        for point, label in zip(self.points, self.point_labels):
+            painter.setBrush(QBrush(QColor('cyan' if label else 'red')))
+            painter.drawEllipse(self.to_widget(QPointF(point) + QPointF(0.5, 0.5)), 4, 4)
+        painter.setBrush(Qt.NoBrush)
+        painter.setPen(QPen(QColor('cyan'), 2))
+        for rect in self.boxes:
+            painter.drawRect(QRectF(self.to_widget(rect.topLeft()), self.to_widget(rect.bottomRight())))
+        if self.drag_rect is not None:
+            painter.setPen(QPen(QColor('cyan'), 1, Qt.DashLine))
+            painter.drawRect(QRectF(self.to_widget(self.drag_rect.topLeft()), self.to_widget(self.drag_rect.bottomRight())))
+
+    # the part of the finest decoded coarser tile that covers rect (x, y, w, h) of level
+    def draw_placeholder(self, painter, target, level, x, y, w, h):
+        for coarse in range(level + 1, self.image.levels):
+            f = 1 << (coarse - level)
+            tx, ty = x // (f * self.image.tile_size), y // (f * self.image.tile_size)
+            tile = self.image.cached_tile(coarse, tx, ty)
+            if tile is None: continue
+            source = QRectF(x / f - tx * self.image.tile_size, y / f - ty * self.image.tile_size, w / f, h / f)
+            painter.drawImage(target, np_to_qimage(tile), source)
+            return
+
+    @pyqtSlot(object)
+    def tile_loaded(self, image):
+        if image is self.image: self.update()
+
+    def stop(self):
+        self.loader.stop()
+
+    # (x, y, w, h) rect of the image whose labels changed
+    def update_overlay(self, rect):
+        if rect is None or self.overlay_opacity <= 0: return
+        x, y, w, h = rect
+        area = QRectF(self.to_widget(QPointF(x, y)), self.to_widget(QPointF(x + w, y + h)))
+        self.update(area.toAlignedRect().adjusted(-1, -1, 1, 1))
+
+    def set_overlay_opacity(self, opacity):
+        self.overlay_opacity = opacity
+        self.update()
+
+    def wheelEvent(self, event):
+        if self.image is None: return
+        pos = event.pos()
+        anchor = self.to_image(pos) # stays under the cursor
+        fit = min(self.width() / self.image.width, self.height() / self.image.height)
+        factor = 1.25 ** (event.angleDelta().y() / 120)
+        self.scale = min(max(self.scale * factor, fit / 2), 8.0)
+        self.origin = anchor - QPointF(pos) / self.scale
+        self.moved = True
+        self.update()
+        self.view_changed.emit()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.MiddleButton or \
+                (event.button() == Qt.LeftButton and event.modifiers() & Qt.ControlModifier):
+            self.pan_start = (event.pos(), QPointF(self.origin))
+            return
+        self.pressed.emit(event)
+
+    def mouseMoveEvent(self, event):
+        if self.pan_start is not None:
+            pos, origin = self.pan_start
+            self.origin = origin - QPointF(event.pos() - pos) / self.scale
+            self.moved = True
+            self.update()
+        elif self.drag_start is not None:
+            self.drag_rect = QRectF(self.drag_start, self._clamp(self.to_image(event.pos()))).normalized()
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if self.pan_start is not None:
+            self.pan_start = None
+            self.view_changed.emit()
+        elif self.drag_start is not None:
+            rect = QRectF(self.drag_start, self._clamp(self.to_image(event.pos()))).normalized()
+            if rect.width() > 1 and rect.height() > 1: self.boxes.append(rect)
+            self.drag_start = None
+            self.drag_rect = None
+            self.update()
+
+    def clear_points(self):
+        self.points.clear()
+        self.point_labels.clear()
+        self.boxes.clear()
+        self.drag_start = None
+        self.drag_rect = None
+        self.update()
+
+    # point is a QPoint in image coordinates, see image_pos
+    def update_points(self, point, draw=True, label=1):
+        self.points.append(point)
+        self.point_labels.append(label)
+        if draw: self.update()
+
+    def get_points(self):
+        return [[p.x(), p.y()] for p in self.points]
+
+    def get_point_labels(self):
+        return list(self.point_labels)
+
+    # rubber band box drawing, started by the owner on mouse press
+    def start_box(self, pos):
+        self.drag_start = self._clamp(self.to_image(pos))
+        self.drag_rect = QRectF(self.drag_start, self.drag_start)
+        self.update()
+
+    # [[x1, y1, x2, y2], ...] in image coordinates
+    def get_boxes(self):
+        return [[int(r.left()), int(r.top()), int(r.right()), int(r.bottom())] for r in self.boxes]
+
+    def _clamp(self, point):
+        return QPointF(min(max(point.x(), 0), self.image.width - 1), min(max(point.y(), 0), self.image.height - 1))